@@ -5,6 +5,7 @@ import logging
 import os
 import secrets
 from database import db
+from utils.metrics import metrics
 
 # Configure logging
 logging.basicConfig(
@@ -50,8 +51,8 @@ CORS(app,
                  "https://vincefrontend.vercel.app"
              ],
              "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-             "allow_headers": ["Content-Type", "Authorization"],
-             "expose_headers": ["Content-Type", "Authorization"],
+             "allow_headers": ["Content-Type", "Authorization", "Range", "If-Range", "X-Chunk-SHA256", "Last-Event-ID"],
+             "expose_headers": ["Content-Type", "Authorization", "Accept-Ranges", "Content-Range", "Content-Length"],
              "supports_credentials": True
          }
      })
@@ -65,7 +66,7 @@ def after_request(response):
         'https://vincefrontend.vercel.app'
     ]:
         response.headers.add('Access-Control-Allow-Origin', origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,Range,If-Range,X-Chunk-SHA256,Last-Event-ID')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
         response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
@@ -78,9 +79,13 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # Register blueprints
 from routes.songs import songs
 from routes.auth import auth
+from routes.uploads import uploads
+from routes.jobs import jobs
 
 app.register_blueprint(songs)
 app.register_blueprint(auth)
+app.register_blueprint(uploads)
+app.register_blueprint(jobs)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -95,16 +100,25 @@ def catch_all(path):
                 'auth': {
                     'register': '/api/auth/register',
                     'login': '/api/auth/login',
+                    'logout': '/api/auth/logout',
                     'profile': '/api/auth/profile'
                 },
                 'songs': {
                     'list': '/api/songs',
                     'upload': '/api/songs/upload',
                     'upload_spotify': '/api/songs/upload/spotify',
+                    'upload_check': '/api/songs/upload/check',
+                    'upload_sessions': '/api/songs/upload/sessions',
                     'stream': '/api/songs/stream/<song_id>',
+                    'stream_url': '/api/songs/stream/<song_id>/url',
                     'download': '/api/songs/download/<song_id>'
                 },
-                'health': '/health'
+                'jobs': {
+                    'status': '/api/jobs/<job_id>',
+                    'events': '/api/jobs/events'
+                },
+                'health': '/health',
+                'metrics': '/metrics'
             },
             'status': 'running',
             'environment': os.getenv('FLASK_ENV', 'production')
@@ -115,13 +129,20 @@ def catch_all(path):
         'available_endpoints': [
             '/api/auth/register',
             '/api/auth/login',
+            '/api/auth/logout',
             '/api/auth/profile',
             '/api/songs',
             '/api/songs/upload',
             '/api/songs/upload/spotify',
+            '/api/songs/upload/check',
+            '/api/songs/upload/sessions',
             '/api/songs/stream/<song_id>',
+            '/api/songs/stream/<song_id>/url',
             '/api/songs/download/<song_id>',
-            '/health'
+            '/api/jobs/<job_id>',
+            '/api/jobs/events',
+            '/health',
+            '/metrics'
         ]
     }), 404
 
@@ -144,6 +165,11 @@ def health_check():
             'error': str(e)
         }), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics_snapshot():
+    """In-process counters, gauges and timings for this worker"""
+    return jsonify(metrics.snapshot())
+
 # This is required for Vercel
 app = app
 
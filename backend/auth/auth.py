@@ -1,14 +1,176 @@
 from functools import wraps
-from flask import request, jsonify, current_app
+from collections import OrderedDict
+from flask import request, jsonify, current_app, g
 import jwt
 from models.models import User
 import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
 from database import db
 from bson import ObjectId
 from bson.errors import InvalidId
+from utils.metrics import metrics
+from utils.signing import verify_stream_url
 
 logger = logging.getLogger(__name__)
 
+# Verified users are kept this long before token_required reads them again
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+
+# 'stateless' trusts the token's claims and never reads the user on a request;
+# 'cached' (the default) loads the user through UserCache
+AUTH_MODE = os.getenv('AUTH_MODE', 'cached')
+TOKEN_LIFETIME = timedelta(hours=float(os.getenv('TOKEN_LIFETIME_HOURS', '24')))
+# How stale the in-memory list of revoked tokens may get
+REVOCATION_REFRESH_SECONDS = float(os.getenv('REVOCATION_REFRESH_SECONDS', '5'))
+
+class UserCache:
+    """Bounded LRU of user documents by id, each entry valid for ttl seconds.
+
+    Saves token_required a users lookup on every request. The cache is per
+    process, so invalidate() only reaches this one; other processes pick up
+    a change once their entry expires, which is what bounds ttl.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        metrics.gauge('user_cache.size', lambda: len(self._entries))
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(user_id, None)
+                metrics.incr('user_cache.misses')
+                return None
+            self._entries.move_to_end(user_id)
+        metrics.incr('user_cache.hits')
+        return entry[1]
+
+    def put(self, user_id, user_data):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user_data)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+
+user_cache = UserCache()
+
+def invalidate_user(user_id):
+    """Call after changing or deleting a user so this process stops serving the cached copy"""
+    user_cache.invalidate(user_id)
+
+class Principal:
+    """The authenticated user as the token describes it, for AUTH_MODE=stateless.
+
+    Carries what most routes need (_id and username) without a database read;
+    use load_user() for anything else.
+    """
+
+    def __init__(self, user_id, username):
+        self._id = ObjectId(user_id)
+        self.username = username
+
+    @staticmethod
+    def from_claims(claims):
+        return Principal(claims['sub'], claims.get('username'))
+
+class RevocationList:
+    """In-memory set of revoked token ids (jti), refreshed from MongoDB.
+
+    Each refresh only reads revocations newer than the last one seen, at most
+    once every refresh_interval seconds per process, so a revoked token stops
+    working everywhere within that long. Entries are dropped once the token
+    would have expired anyway, which keeps the set small.
+    """
+
+    # Re-read a little before the newest revocation seen, in case of clock skew between writers
+    OVERLAP = timedelta(seconds=5)
+
+    def __init__(self, collection, refresh_interval=REVOCATION_REFRESH_SECONDS):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._revoked = {}
+        self._since = None
+        self._next_refresh = 0.0
+
+        metrics.gauge('revoked_tokens.size', lambda: len(self._revoked))
+
+    def is_revoked(self, jti):
+        if time.monotonic() >= self._next_refresh and self._lock.acquire(blocking=False):
+            # One request refreshes, the others carry on with what we have
+            try:
+                self._refresh()
+            finally:
+                self._lock.release()
+        return jti in self._revoked
+
+    def _refresh(self):
+        query = {'revoked_at': {'$gte': self._since - self.OVERLAP}} if self._since else {}
+        try:
+            for doc in self.collection.find(query, {'expires_at': 1, 'revoked_at': 1}):
+                self._revoked[doc['_id']] = doc['expires_at']
+                if self._since is None or doc['revoked_at'] > self._since:
+                    self._since = doc['revoked_at']
+            if self._since is None:
+                self._since = datetime.utcnow()
+            metrics.incr('revoked_tokens.refreshes')
+        except Exception as e:
+            # Keep serving from what we have; try again next interval
+            logger.error(f"Error refreshing revoked tokens: {str(e)}")
+        now = datetime.utcnow()
+        self._revoked = {jti: expires for jti, expires in self._revoked.items() if expires > now}
+        self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def revoke(self, claims):
+        """Revoke a token by its claims, here straight away and elsewhere on their next refresh"""
+        expires_at = datetime.utcfromtimestamp(claims['exp'])
+        self.collection.update_one(
+            {'_id': claims['jti']},
+            {'$setOnInsert': {
+                'user_id': claims['sub'],
+                'expires_at': expires_at,
+                'revoked_at': datetime.utcnow()
+            }},
+            upsert=True
+        )
+        with self._lock:
+            self._revoked[claims['jti']] = expires_at
+
+revoked_tokens = RevocationList(db.revoked_tokens)
+
+def issue_token(user):
+    """A signed token for a user; jti lets it be revoked on its own"""
+    return jwt.encode({
+        'sub': str(user._id),
+        'username': user.username,
+        'jti': uuid.uuid4().hex,
+        'exp': datetime.utcnow() + TOKEN_LIFETIME
+    }, current_app.config['SECRET_KEY'])
+
+def load_user(user_id, object_id):
+    """The user document for an id, from the cache or MongoDB; None if there's no such user"""
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        user_data = db.users.find_one({'_id': object_id})
+        logger.debug(f"Database query result: {user_data}")
+        if user_data:
+            user_cache.put(user_id, user_data)
+    return user_data
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -55,18 +217,18 @@ def token_required(f):
             except InvalidId as e:
                 logger.error(f"Invalid ObjectId format: {user_id}")
                 return jsonify({'message': 'Invalid user ID format'}), 401
-            
-            # Log MongoDB connection status
-            try:
-                db.client.server_info()
-                logger.debug("MongoDB connection is active")
-            except Exception as e:
-                logger.error(f"MongoDB connection error: {str(e)}")
-                return jsonify({'message': 'Database connection error'}), 500
-            
-            # Find user in database
-            user_data = db.users.find_one({'_id': object_id})
-            logger.debug(f"Database query result: {user_data}")
+
+            # Tokens issued before jti was added can't be revoked; they expire within a day
+            if data.get('jti') and revoked_tokens.is_revoked(data['jti']):
+                logger.error(f"Token {data['jti']} has been revoked")
+                return jsonify({'message': 'Token has been revoked'}), 401
+            g.token_claims = data
+
+            if AUTH_MODE == 'stateless':
+                return f(Principal.from_claims(data), *args, **kwargs)
+
+            # Find user in the cache or database
+            user_data = load_user(user_id, object_id)
             
             if not user_data:
                 logger.error(f"No user found for ID: {user_id}")
@@ -90,4 +252,24 @@ def token_required(f):
             logger.error(f"Error processing token: {str(e)}")
             return jsonify({'message': 'Error processing token', 'error': str(e)}), 401
     
-    return decorated
\ No newline at end of file
+    return decorated
+
+def stream_auth_required(f):
+    """token_required, or a signed stream URL (see utils.signing) for the song_id route argument.
+
+    A signed URL is checked with one HMAC and no database access; its grant
+    is left in g.stream_grant.
+    """
+    with_token = token_required(f)
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if 'sig' not in request.args:
+            return with_token(*args, **kwargs)
+        grant = verify_stream_url(kwargs['song_id'], request.args)
+        if not grant:
+            return jsonify({'message': 'Invalid or expired stream URL'}), 403
+        g.stream_grant = grant
+        return f(Principal(grant['user_id'], None), *args, **kwargs)
+
+    return decorated
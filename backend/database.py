@@ -1,6 +1,9 @@
 from pymongo import MongoClient
+from pymongo import monitoring
+from contextlib import contextmanager
 import os
 import logging
+import threading
 from urllib.parse import quote_plus
 
 # Configure logging
@@ -10,6 +13,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class QueryCounter(monitoring.CommandListener):
+    """Counts the commands (round trips) the current thread sends to MongoDB.
+
+    Only counts inside count_queries(), so it costs nothing otherwise.
+    Command events are published on the thread that issued the command.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def started(self, event):
+        commands = getattr(self._local, 'commands', None)
+        if commands is not None:
+            commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+query_counter = QueryCounter()
+
+@contextmanager
+def count_queries():
+    """Collect the names of the commands sent to MongoDB by this thread inside the block"""
+    previous = getattr(query_counter._local, 'commands', None)
+    commands = query_counter._local.commands = []
+    try:
+        yield commands
+    finally:
+        query_counter._local.commands = previous
+        if previous is not None:
+            previous.extend(commands)
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail with AssertionError if the block sends MongoDB more than limit commands.
+
+    For tests, e.g. keeping register at one write:
+
+        with app.test_client() as client, assert_max_queries(1):
+            client.post('/api/auth/register', json={...})
+    """
+    with count_queries() as commands:
+        yield commands
+    assert len(commands) <= limit, f"Expected at most {limit} MongoDB round trips, got {len(commands)}: {commands}"
+
 def get_database():
     try:
         # Get MongoDB URI from environment
@@ -24,7 +75,8 @@ def get_database():
         client = MongoClient(MONGO_URI, 
                            serverSelectionTimeoutMS=5000,  # 5 second timeout
                            connectTimeoutMS=5000,
-                           socketTimeoutMS=5000)
+                           socketTimeoutMS=5000,
+                           event_listeners=[query_counter])
         
         # Test the connection
         client.admin.command('ping')
@@ -40,9 +92,37 @@ def get_database():
         try:
             db.users.create_index('username', unique=True)
             db.users.create_index('email', unique=True)
+            # Resumable upload sessions expire on their own
+            db.upload_sessions.create_index('expires_at', expireAfterSeconds=0)
+            # Background job queue: claim lookups and per-user listings
+            db.jobs.create_index([('status', 1), ('priority', -1), ('created_at', 1), ('not_before', 1)])
+            db.jobs.create_index([('status', 1), ('lease_until', 1)])
+            db.jobs.create_index([('user_id', 1), ('created_at', 1)])
+            # Spotify track metadata cache entries expire on their own
+            db.spotify_tracks.create_index('expires_at', expireAfterSeconds=0)
+            # Searched YouTube matches expire, manual overrides have no expires_at
+            db.youtube_matches.create_index('expires_at', expireAfterSeconds=0)
+            # Single-flight download leases and their published results
+            db.download_leases.create_index('expires_at', expireAfterSeconds=0)
+            # Download slots shared by worker processes; idle per-user slots expire
+            db.download_slots.create_index('expires_at', expireAfterSeconds=0)
+            # Revoked tokens are forgotten once they'd have expired anyway
+            db.revoked_tokens.create_index('expires_at', expireAfterSeconds=0)
+            db.revoked_tokens.create_index('revoked_at')
             logger.debug("Database indexes created/verified")
         except Exception as e:
             logger.error(f"Error creating indexes: {str(e)}")
+
+        # Job progress events are tailed by the SSE endpoint, which needs a capped collection
+        try:
+            if 'job_events' not in db.list_collection_names():
+                db.create_collection('job_events', capped=True, size=int(os.getenv('JOB_EVENTS_MB', '16')) * 1024 * 1024)
+                logger.debug("Created capped job_events collection")
+            # Replays when a stream opens: a job's events, or a user's since a given one
+            db.job_events.create_index([('job_id', 1), ('created_at', 1)])
+            db.job_events.create_index([('user_id', 1), ('created_at', 1)])
+        except Exception as e:
+            logger.error(f"Error creating job_events collection: {str(e)}")
         
         return db
         
@@ -0,0 +1,58 @@
+"""Move files from the flat uploads/ directory into the sharded layout.
+
+Safe to run while the app is serving: every file is moved with an atomic
+rename and readers look in the sharded location first, then the flat one.
+Song documents don't change, they only store the file name.
+
+    python migrate_uploads.py [--batch-size 500] [--pause 0.5] [--dry-run]
+"""
+from utils.storage import migrate_file, sharded_path
+import argparse
+import os
+import time
+
+def flat_files(root):
+    """Files still sitting directly in the uploads dir (temp and dot files skipped)"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                yield entry.name
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate uploads to the sharded layout')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.5, help='Seconds to sleep between batches')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        print(f"Uploads directory not found: {args.root}")
+        return
+
+    moved = 0
+    failed = 0
+    batch = 0
+    for name in flat_files(args.root):
+        if args.dry_run:
+            print(f"{name} -> {os.path.relpath(sharded_path(args.root, name), args.root)}")
+        else:
+            try:
+                if migrate_file(args.root, name):
+                    moved += 1
+            except OSError as e:
+                failed += 1
+                print(f"Failed to move {name}: {e}")
+
+        batch += 1
+        if batch >= args.batch_size:
+            print(f"Moved {moved} files so far ({failed} failures)")
+            batch = 0
+            time.sleep(args.pause)
+
+    print(f"Done: moved {moved} files, {failed} failures")
+
+if __name__ == '__main__':
+    main()
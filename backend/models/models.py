@@ -1,5 +1,5 @@
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from utils.passwords import password_hasher
 from bson import ObjectId
 import logging
 
@@ -12,21 +12,21 @@ class User:
         self.email = email
         if password:
             logger.debug(f"Generating password hash for user: {username}")
-            self.password_hash = generate_password_hash(password)
+            self.password_hash = password_hasher.hash(password)
         else:
             self.password_hash = None
         self.created_at = datetime.utcnow()
 
     def set_password(self, password):
         logger.debug(f"Setting new password for user: {self.username}")
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
         logger.debug(f"Checking password for user: {self.username}")
         if not self.password_hash:
             logger.error(f"No password hash found for user: {self.username}")
             return False
-        result = check_password_hash(self.password_hash, password)
+        result = password_hasher.verify(self.password_hash, password)
         if not result:
             logger.error(f"Password check failed for user: {self.username}")
         return result
@@ -67,7 +67,9 @@ class User:
             raise
 
 class Song:
-    def __init__(self, title, file_path, user_id, artist=None, album=None, duration=None, cover_art=None, _id=None):
+    def __init__(self, title, file_path, user_id, artist=None, album=None, duration=None, cover_art=None, _id=None,
+                 bitrate=None, sample_rate=None, channels=None, codec=None, sha256=None, size=None,
+                 blob_id=None):
         self._id = str(_id) if _id else str(ObjectId())
         self.title = title
         self.artist = artist
@@ -75,6 +77,13 @@ class Song:
         self.duration = duration
         self.cover_art = cover_art
         self.file_path = file_path
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.codec = codec
+        self.sha256 = sha256
+        self.size = size
+        self.blob_id = blob_id
         self.user_id = str(user_id) if isinstance(user_id, (str, ObjectId)) else user_id
         self.created_at = datetime.utcnow()
 
@@ -90,7 +99,14 @@ class Song:
             duration=db_object.get('duration'),
             cover_art=db_object.get('cover_art'),
             file_path=db_object['file_path'],
-            user_id=db_object['user_id']
+            user_id=db_object['user_id'],
+            bitrate=db_object.get('bitrate'),
+            sample_rate=db_object.get('sample_rate'),
+            channels=db_object.get('channels'),
+            codec=db_object.get('codec'),
+            sha256=db_object.get('sha256'),
+            size=db_object.get('size'),
+            blob_id=db_object.get('blob_id')
         )
 
     def to_dict(self):
@@ -102,6 +118,13 @@ class Song:
             'duration': self.duration,
             'cover_art': self.cover_art,
             'file_path': self.file_path,
+            'bitrate': self.bitrate,
+            'sample_rate': self.sample_rate,
+            'channels': self.channels,
+            'codec': self.codec,
+            'sha256': self.sha256,
+            'size': self.size,
+            'blob_id': self.blob_id,
             'user_id': self.user_id,
             'created_at': self.created_at
         } 
\ No newline at end of file
@@ -1,91 +1,28 @@
-from flask import Blueprint, request, jsonify, current_app
-import jwt
-from datetime import datetime, timedelta
+from flask import Blueprint, request, jsonify, g
 import logging
 from models.models import User
 from database import db
-from functools import wraps
-from bson import ObjectId
-from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+from auth.auth import Principal, invalidate_user, issue_token, load_user, revoked_tokens, token_required
+from utils.passwords import password_hasher
+from utils.scheduler import QueueFull
 
 logger = logging.getLogger(__name__)
 auth = Blueprint('auth', __name__)
 
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        auth_header = request.headers.get('Authorization')
-        
-        # Log all request details
-        logger.debug("=== Token Verification Debug ===")
-        logger.debug(f"Request Method: {request.method}")
-        logger.debug(f"Request Path: {request.path}")
-        logger.debug(f"All Headers: {dict(request.headers)}")
-        logger.debug(f"Auth Header: {auth_header}")
-        
-        if auth_header:
-            try:
-                token = auth_header.split(" ")[1]
-                logger.debug(f"Token extracted: {token[:20]}...")
-            except IndexError:
-                logger.error("Malformed Authorization header")
-                return jsonify({'message': 'Invalid token format'}), 401
-        
-        if not token:
-            logger.error("No token provided")
-            return jsonify({'message': 'Token is missing'}), 401
+def busy_response(e):
+    """503 for when password hashing is backed up, so clients retry instead of piling on"""
+    logger.warning(f"Password hashing busy, asking client to retry in {e.retry_after}s")
+    response = jsonify({'message': 'Server is busy, please retry shortly'})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
 
-        try:
-            # Log the token decoding attempt
-            logger.debug(f"Attempting to decode token...")
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
-            logger.debug(f"Token decoded successfully. Data: {data}")
-            
-            if 'sub' not in data:
-                logger.error("Token missing 'sub' claim")
-                return jsonify({'message': 'Invalid token format - missing user ID'}), 401
-                
-            user_id = data['sub']
-            logger.debug(f"User ID from token: {user_id}")
-            
-            try:
-                # Convert string ID to ObjectId
-                object_id = ObjectId(user_id)
-                logger.debug(f"Successfully converted to ObjectId: {object_id}")
-            except InvalidId as e:
-                logger.error(f"Invalid ObjectId format: {user_id}")
-                return jsonify({'message': 'Invalid user ID format'}), 401
-            
-            # Log MongoDB query
-            logger.debug(f"Executing MongoDB query for user ID: {object_id}")
-            user_data = db.users.find_one({'_id': object_id})
-            logger.debug(f"MongoDB query result: {user_data}")
-            
-            if not user_data:
-                logger.error(f"No user found for ID: {user_id}")
-                return jsonify({'message': 'User not found'}), 401
-            
-            try:
-                current_user = User.from_db_object(user_data)
-                logger.debug(f"User object created successfully: {current_user.username}")
-            except Exception as e:
-                logger.error(f"Error creating User object: {str(e)}")
-                return jsonify({'message': 'Error processing user data'}), 500
-            
-            return f(current_user, *args, **kwargs)
-            
-        except jwt.ExpiredSignatureError:
-            logger.error("Token has expired")
-            return jsonify({'message': 'Token has expired'}), 401
-        except jwt.InvalidTokenError as e:
-            logger.error(f"Invalid token: {str(e)}")
-            return jsonify({'message': 'Invalid token', 'error': str(e)}), 401
-        except Exception as e:
-            logger.error(f"Error processing token: {str(e)}")
-            return jsonify({'message': 'Error processing token', 'error': str(e)}), 401
-    
-    return decorated
+def duplicate_field(error):
+    """Which unique user field ('username' or 'email') a DuplicateKeyError is about"""
+    key = (error.details or {}).get('keyPattern') or {}
+    if 'email' in key or ('username' not in key and 'email_' in str(error)):
+        return 'email'
+    return 'username'
 
 @auth.route('/api/auth/register', methods=['POST'])
 def register():
@@ -97,17 +34,6 @@ def register():
             logger.error("Missing required fields in registration request")
             return jsonify({'message': 'Missing required fields'}), 400
         
-        # Check if user already exists
-        existing_user = db.users.find_one({'username': data['username']})
-        if existing_user:
-            logger.error(f"Username {data['username']} already exists")
-            return jsonify({'message': 'Username already exists'}), 400
-        
-        existing_email = db.users.find_one({'email': data['email']})
-        if existing_email:
-            logger.error(f"Email {data['email']} already exists")
-            return jsonify({'message': 'Email already exists'}), 400
-        
         # Create new user
         new_user = User(
             username=data['username'],
@@ -116,25 +42,20 @@ def register():
         )
         logger.debug(f"Created new user object for {data['username']}")
         
-        # Insert into MongoDB
+        # Insert into MongoDB; the unique indexes on username and email catch duplicates
         user_dict = new_user.to_dict()
         logger.debug(f"User dict before insert: {user_dict}")
-        result = db.users.insert_one(user_dict)
+        try:
+            result = db.users.insert_one(user_dict)
+        except DuplicateKeyError as e:
+            field = duplicate_field(e)
+            logger.error(f"{field.capitalize()} {data[field]} already exists")
+            return jsonify({'message': f'{field.capitalize()} already exists'}), 400
         new_user._id = result.inserted_id
         logger.debug(f"Inserted new user with ID: {new_user._id}")
         
-        # Verify the user was inserted
-        inserted_user = db.users.find_one({'_id': new_user._id})
-        logger.debug(f"Verification - Found user in DB: {inserted_user}")
-        
         # Generate token
-        token_data = {
-            'sub': str(new_user._id),
-            'username': new_user.username,
-            'exp': datetime.utcnow() + timedelta(days=1)
-        }
-        logger.debug(f"Token data: {token_data}")
-        token = jwt.encode(token_data, current_app.config['SECRET_KEY'])
+        token = issue_token(new_user)
         logger.debug(f"Generated token: {token[:20]}...")
         
         return jsonify({
@@ -142,6 +63,8 @@ def register():
             'username': new_user.username,
             'message': 'User created successfully'
         }), 201
+    except QueueFull as e:
+        return busy_response(e)
     except Exception as e:
         logger.error(f"Error in registration: {str(e)}")
         return jsonify({'message': f'Registration failed: {str(e)}'}), 500
@@ -168,19 +91,27 @@ def login():
         if not user.check_password(data['password']):
             logger.error(f"Invalid password for user: {user.username}")
             return jsonify({'message': 'Invalid username or password'}), 401
+
+        # Upgrade hashes made with older parameters while we have the password
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.set_password(data['password'])
+                db.users.update_one({'_id': user_data['_id']}, {'$set': {'password_hash': user.password_hash}})
+                invalidate_user(user._id)
+                logger.debug(f"Rehashed password for user: {user.username}")
+            except Exception as e:
+                logger.error(f"Error rehashing password for {user.username}: {str(e)}")
         
         # Generate token
-        token = jwt.encode({
-            'sub': str(user._id),
-            'username': user.username,
-            'exp': datetime.utcnow() + timedelta(days=1)
-        }, current_app.config['SECRET_KEY'])
+        token = issue_token(user)
         logger.debug(f"Generated token for user: {token[:20]}...")
         
         return jsonify({
             'token': token,
             'username': user.username
         })
+    except QueueFull as e:
+        return busy_response(e)
     except Exception as e:
         logger.error(f"Error in login: {str(e)}")
         return jsonify({'message': f'Login failed: {str(e)}'}), 500
@@ -191,16 +122,13 @@ def get_profile(current_user):
     try:
         logger.debug(f"Profile request for user: {current_user.username}")
         logger.debug(f"User ID: {current_user._id}")
+        if isinstance(current_user, Principal):
+            # Stateless auth only knows what's in the token
+            current_user = User.from_db_object(load_user(str(current_user._id), current_user._id))
+            if not current_user:
+                return jsonify({'message': 'User not found'}), 404
         logger.debug(f"User object: {current_user.to_dict()}")
         
-        # Double-check user exists in database
-        user_data = db.users.find_one({'_id': current_user._id})
-        logger.debug(f"User data from DB: {user_data}")
-        
-        if not user_data:
-            logger.error(f"User not found in database: {current_user._id}")
-            return jsonify({'message': 'User not found in database'}), 404
-            
         return jsonify({
             'user': {
                 '_id': str(current_user._id),
@@ -212,4 +140,19 @@ def get_profile(current_user):
         logger.error(f"Error fetching profile: {str(e)}")
         return jsonify({
             'message': f'Failed to fetch profile: {str(e)}'
-        }), 500 
\ No newline at end of file
+        }), 500
+
+@auth.route('/api/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user):
+    """Revoke the token this request was made with"""
+    try:
+        claims = g.token_claims
+        if not claims.get('jti'):
+            return jsonify({'message': 'Token cannot be revoked'}), 400
+        revoked_tokens.revoke(claims)
+        logger.debug(f"Revoked token {claims['jti']} for user: {current_user.username}")
+        return jsonify({'message': 'Logged out'})
+    except Exception as e:
+        logger.error(f"Error logging out: {str(e)}")
+        return jsonify({'message': f'Logout failed: {str(e)}'}), 500
@@ -0,0 +1,61 @@
+from flask import Blueprint, Response, jsonify, request
+from auth.auth import token_required
+from utils.events import follow_events
+from utils.jobs import job_queue, job_to_dict
+from bson import ObjectId
+from bson.errors import InvalidId
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+jobs = Blueprint('jobs', __name__)
+
+@jobs.route('/api/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_job(current_user, job_id):
+    try:
+        job = job_queue.get(job_id, user_id=current_user._id)
+        if not job:
+            return jsonify({'message': 'Job not found'}), 404
+        return jsonify({'job': job_to_dict(job)}), 200
+    except Exception as e:
+        logger.error(f"Error fetching job {job_id}: {str(e)}")
+        return jsonify({'message': f'Failed to fetch job: {str(e)}'}), 500
+
+def event_to_sse(event):
+    """One job event in text/event-stream framing"""
+    data = {key: value for key, value in event.items() if key not in ('_id', 'user_id', 'created_at')}
+    data['created_at'] = event['created_at'].isoformat()
+    return f"id: {event['_id']}\nevent: {event['stage']}\ndata: {json.dumps(data)}\n\n"
+
+@jobs.route('/api/jobs/events', methods=['GET'])
+@token_required
+def job_events(current_user):
+    """Server-Sent Events stream of the user's job progress"""
+    # ?job=<id> follows one job, replaying what it already published; a
+    # reconnecting browser sends the last event id it saw to resume from
+    job_id = request.args.get('job')
+    if job_id and not job_queue.get(job_id, user_id=current_user._id):
+        return jsonify({'message': 'Job not found'}), 404
+    after = None
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        try:
+            after = ObjectId(last_event_id)
+        except InvalidId:
+            return jsonify({'message': 'Invalid event id'}), 400
+    user_id = str(current_user._id)
+    logger.debug(f"Opening job event stream for user {user_id}")
+
+    def generate():
+        # Tell the browser how long to wait before reconnecting
+        yield 'retry: 3000\n\n'
+        for event in follow_events(user_id, job_id=job_id, after=after):
+            # Comments keep proxies from timing the stream out
+            yield event_to_sse(event) if event else ': keepalive\n\n'
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
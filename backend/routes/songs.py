@@ -1,16 +1,23 @@
-from flask import Blueprint, request, jsonify, current_app, send_from_directory, send_file, after_this_request
-from werkzeug.utils import secure_filename
+from flask import Blueprint, request, jsonify, send_from_directory, g
 from models.models import Song
-from auth.auth import token_required
+from auth.auth import stream_auth_required, token_required
 import os
-from datetime import datetime
 from database import db
-from utils.spotify import SpotifyDownloader
+from utils.spotify import parse_spotify_url
+from utils.streaming import audio_mimetype, send_audio, stream_audio, wants_inline
+from utils.transcode import RENDITIONS, StreamingFill, TranscodeError, follow_fill, transcode_file, transcode_scheduler
+from utils.scheduler import QueueFull
+from utils.ingest import IngestError, MAX_UPLOAD_BYTES, ingest_stream
+from utils.library import ALLOWED_EXTENSIONS, add_uploaded_song, allowed_file, delete_song_file
+from utils.storage import get_uploads_dir, locate
+from utils.signing import sign_stream_url
+from utils.rendition_cache import get_rendition_cache, rendition_key, source_hash
+from utils.jobs import job_queue, job_to_dict
+from utils.imports import SPOTIFY_COLLECTION_IMPORT, SPOTIFY_IMPORT
 import tempfile
-from bson import ObjectId
 from dotenv import load_dotenv
 import logging
-import subprocess
+import time
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -20,60 +27,60 @@ load_dotenv()
 
 songs = Blueprint('songs', __name__)
 
-ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg'}
-
-# Initialize Spotify downloader with credentials from env
-spotify_downloader = SpotifyDownloader(
-    client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-    client_secret=os.getenv('SPOTIFY_CLIENT_SECRET')
-)
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Pipe cache misses through ffmpeg to the client instead of converting first
+STREAM_TRANSCODE = os.getenv('STREAM_TRANSCODE', 'true').lower() == 'true'
+# How long a request waits for someone else's conversion of the same rendition
+TRANSCODE_WAIT_TIMEOUT = int(os.getenv('TRANSCODE_WAIT_TIMEOUT', '300'))
+# How long browsers may reuse a song fetched through a signed URL
+STREAM_CACHE_SECONDS = int(os.getenv('STREAM_CACHE_SECONDS', '300'))
 
 @songs.route('/api/songs/upload', methods=['POST'])
 @token_required
 def upload_song(current_user):
-    if 'file' not in request.files:
-        return jsonify({'message': 'No file provided'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
+    # Refuse oversized uploads before reading any of the body
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({'message': f'File is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB'}), 413
+
+    # Raw audio bodies (what the web app sends) are streamed straight from the
+    # socket; multipart uploads from other clients go through werkzeug's form
+    # parser, which spools the file first
+    if request.mimetype.startswith('audio/') or request.mimetype == 'application/octet-stream':
+        stream = request.stream
+        original_filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+        title_field = request.args.get('title')
+    else:
+        if 'file' not in request.files:
+            return jsonify({'message': 'No file provided'}), 400
+        file = request.files['file']
+        stream = file.stream
+        original_filename = file.filename
+        title_field = request.form.get('title')
+
+    if original_filename == '':
         return jsonify({'message': 'No file selected'}), 400
 
-    if not allowed_file(file.filename):
+    if not allowed_file(original_filename):
         return jsonify({'message': 'Invalid file type'}), 400
 
+    ingested = None
     try:
-        # Create uploads directory if it doesn't exist
-        uploads_dir = os.path.join(current_app.root_path, 'uploads')
-        os.makedirs(uploads_dir, exist_ok=True)
-
-        # Secure the filename and save the file
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(uploads_dir, unique_filename)
-        
-        file.save(file_path)
-
-        # Create song record in MongoDB
-        title = request.form.get('title', filename)
-        new_song = Song(
-            title=title,
-            file_path=unique_filename,
-            user_id=ObjectId(str(current_user._id))
-        )
-        
-        # Insert into MongoDB
-        result = db.songs.insert_one(new_song.to_dict())
+        # Sniff, hash and spool the upload in chunks next to the uploads dir
+        ingested = ingest_stream(stream, get_uploads_dir(), MAX_UPLOAD_BYTES, allowed_formats=ALLOWED_EXTENSIONS)
+
+        # Move it into place and create the song record in MongoDB
+        new_song = add_uploaded_song(current_user._id, ingested, original_filename, title_field)
 
         return jsonify({
             'message': 'Song uploaded successfully',
             'song': new_song.to_dict()
         }), 201
 
+    except IngestError as e:
+        logger.error(f"Rejected upload: {str(e)}")
+        return jsonify({'message': str(e)}), e.status
     except Exception as e:
+        if ingested:
+            ingested.discard()
         return jsonify({
             'message': f'Failed to upload song: {str(e)}'
         }), 500
@@ -97,71 +104,29 @@ def upload_spotify(current_user):
         logger.debug(f"Processing Spotify URL: {spotify_url}")
         
         # Validate Spotify URL format
-        if not spotify_url.startswith('https://open.spotify.com/track/'):
-            return jsonify({'message': 'Invalid Spotify URL format. Must be a Spotify track URL.'}), 400
-        
-        # Create uploads directory if it doesn't exist
-        uploads_dir = os.path.join(current_app.root_path, 'uploads')
-        os.makedirs(uploads_dir, exist_ok=True)
-        logger.debug(f"Using uploads directory: {uploads_dir}")
+        parsed = parse_spotify_url(spotify_url)
+        if not parsed:
+            return jsonify({'message': 'Invalid Spotify URL format. Must be a Spotify track, album or playlist URL.'}), 400
+        kind = parsed[0]
         
         # Check if Spotify credentials are available
         if not os.getenv('SPOTIFY_CLIENT_ID') or not os.getenv('SPOTIFY_CLIENT_SECRET'):
             logger.error("Missing Spotify credentials in environment")
             return jsonify({'message': 'Spotify credentials not configured'}), 500
-        
-        try:
-            # Initialize SpotifyDownloader
-            logger.debug("Initializing SpotifyDownloader...")
-            spotify_downloader = SpotifyDownloader(
-                client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-                client_secret=os.getenv('SPOTIFY_CLIENT_SECRET')
-            )
-            
-            # Download the track
-            logger.debug("Starting track download...")
-            track_info = spotify_downloader.download_track(spotify_url, uploads_dir)
-            logger.debug(f"Track info received: {track_info}")
-            
-            # Verify the downloaded file exists
-            file_path = os.path.join(uploads_dir, track_info['file_path'])
-            if not os.path.exists(file_path):
-                logger.error(f"Downloaded file not found at: {file_path}")
-                return jsonify({'message': 'Failed to download track: File not found'}), 500
-            
-            logger.debug(f"File successfully downloaded to: {file_path}")
-            
-            # Create song record in MongoDB
-            new_song = Song(
-                title=track_info['title'],
-                artist=track_info['artist'],
-                album=track_info['album'],
-                duration=track_info['duration'],
-                cover_art=track_info['cover_art'],
-                file_path=track_info['file_path'],
-                user_id=str(current_user._id)
-            )
-            
-            # Insert into MongoDB
-            logger.debug(f"Saving song to MongoDB: {new_song.to_dict()}")
-            result = db.songs.insert_one(new_song.to_dict())
-            logger.debug(f"Song saved with ID: {result.inserted_id}")
-
-            return jsonify({
-                'message': 'Song uploaded successfully',
-                'song': new_song.to_dict()
-            }), 201
-
-        except Exception as e:
-            logger.error(f"Error during Spotify download: {str(e)}")
-            # If there was an error, try to clean up any partially downloaded files
-            try:
-                if 'file_path' in locals():
-                    os.remove(file_path)
-                    logger.debug(f"Cleaned up file after error: {file_path}")
-            except Exception as cleanup_error:
-                logger.error(f"Failed to clean up file: {str(cleanup_error)}")
-            return jsonify({'message': f'Failed to download track: {str(e)}'}), 500
+
+        # Downloading takes seconds to minutes, so hand it to the worker pool
+        # (worker.py) and let the client poll the job
+        if kind == 'track':
+            job = job_queue.enqueue(SPOTIFY_IMPORT, current_user._id, {'url': spotify_url, 'kind': kind})
+        else:
+            job = job_queue.enqueue(SPOTIFY_COLLECTION_IMPORT, current_user._id, {'url': spotify_url, 'kind': kind}, priority='bulk')
+        logger.debug(f"Queued Spotify import job {job['_id']}")
+
+        return jsonify({
+            'message': 'Import queued',
+            'job': job_to_dict(job),
+            'status_url': f"/api/jobs/{job['_id']}"
+        }), 202
 
     except Exception as e:
         logger.error(f"Failed to process Spotify upload: {str(e)}")
@@ -226,24 +191,17 @@ def delete_song(current_user, song_id):
         logger.debug(f"Found song to delete: {song_data}")
         song = Song.from_db_object(song_data)
 
-        # Delete the file
-        try:
-            uploads_dir = os.path.join(current_app.root_path, 'uploads')
-            file_path = os.path.join(uploads_dir, song.file_path)
-            logger.debug(f"Attempting to delete file: {file_path}")
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.debug("File deleted successfully")
-            else:
-                logger.warning("File not found on disk")
-        except Exception as e:
-            logger.error(f"Error deleting file: {str(e)}")
-
         # Delete from MongoDB
         logger.debug("Deleting song from MongoDB")
         result = db.songs.delete_one({'_id': song_id})
         if result.deleted_count > 0:
             logger.debug("Song deleted from MongoDB successfully")
+
+            # Release the file; shared blobs are only unlinked with their last song
+            try:
+                delete_song_file(song)
+            except Exception as e:
+                logger.error(f"Error deleting file: {str(e)}")
         else:
             logger.error("Failed to delete song from MongoDB")
 
@@ -256,14 +214,48 @@ def delete_song(current_user, song_id):
             'message': f'Failed to delete song: {str(e)}'
         }), 500
 
-@songs.route('/api/songs/stream/<song_id>', methods=['GET'])
+@songs.route('/api/songs/stream/<song_id>/url', methods=['POST'])
 @token_required
+def stream_url(current_user, song_id):
+    """A short-lived signed URL for streaming a song, for players that can't send the token"""
+    try:
+        song_data = db.songs.find_one({'_id': song_id, 'user_id': str(current_user._id)}, {'file_path': 1})
+        if not song_data:
+            return jsonify({'message': 'Song not found'}), 404
+        url, expires = sign_stream_url(song_id, current_user._id, song_data['file_path'])
+        return jsonify({'url': url, 'expires': expires}), 200
+    except Exception as e:
+        logger.error(f"Error signing stream URL for song {song_id}: {str(e)}")
+        return jsonify({'message': f'Failed to create stream URL: {str(e)}'}), 500
+
+@songs.route('/api/songs/stream/<song_id>', methods=['GET'])
+@stream_auth_required
 def stream_song(current_user, song_id):
     try:
-        # Get the requested format
-        requested_format = request.args.get('format', 'mp3')
-        logger.debug(f"Streaming song {song_id} in {requested_format} format for user {current_user.username}")
-        
+        # Get the requested format and whether the player wants to stream it inline
+        requested_format = request.args.get('format', 'original').lower()
+        inline = wants_inline()
+        logger.debug(f"Streaming song {song_id} in {requested_format} format for user {current_user._id}")
+
+        # A signed URL names the file, so the original only needs a check that
+        # the song still exists and still uses it, not a full lookup
+        grant = g.get('stream_grant')
+        if grant:
+            source_format = os.path.splitext(grant['file_path'])[1].lstrip('.').lower()
+            if requested_format in ('original', source_format):
+                # Deleted since the URL was signed: its blob may live on for other songs
+                if not db.songs.find_one({'_id': song_id, 'user_id': grant['user_id'], 'file_path': grant['file_path']}, {'_id': 1}):
+                    return jsonify({'message': 'Song not found'}), 404
+                source_path = locate(grant['file_path'])
+                if not os.path.exists(source_path):
+                    return jsonify({'message': 'File not found'}), 404
+                response = send_audio(source_path, f"{song_id}.{source_format}", mimetype=audio_mimetype(source_path), inline=inline)
+                # The URL itself is the credential, so it can be cached, but not for
+                # long: a song deleted meanwhile stays playable from the cache
+                max_age = min(STREAM_CACHE_SECONDS, max(0, grant['expires'] - int(time.time())))
+                response.headers['Cache-Control'] = f"private, max-age={max_age}"
+                return response
+
         # Find the song by ID
         logger.debug(f"Looking for song with ID: {song_id}")
         logger.debug(f"Current user ID: {current_user._id}")
@@ -286,66 +278,85 @@ def stream_song(current_user, song_id):
         logger.debug(f"Found song: {song.title}")
         
         # Get the file path
-        uploads_dir = os.path.join(current_app.root_path, 'uploads')
-        source_path = os.path.join(uploads_dir, song.file_path)
+        source_path = locate(song.file_path)
         logger.debug(f"Source file path: {source_path}")
         
         if not os.path.exists(source_path):
             logger.error(f"Source file not found: {source_path}")
             return jsonify({'message': 'File not found'}), 404
 
-        # If MP3 is requested, send the file directly
-        if requested_format.lower() == 'mp3':
-            logger.debug("Sending MP3 file directly")
-            return send_file(source_path, mimetype='audio/mpeg', as_attachment=True, download_name=f"{song.title}.mp3")
+        # The stored file is sent directly when no other format is asked for (Range requests are honoured)
+        source_format = os.path.splitext(song.file_path)[1].lstrip('.').lower()
+        if requested_format in ('original', source_format):
+            logger.debug(f"Sending {source_format} file directly (inline={inline}, range={request.headers.get('Range')})")
+            return send_audio(source_path, f"{song.title}.{source_format}", mimetype=audio_mimetype(source_path), inline=inline)
         
-        # For WAV conversion
-        if requested_format.lower() == 'wav':
+        # For WAV, MP3 (and other) renditions, serve from the rendition cache
+        rendition = RENDITIONS.get(requested_format)
+        if rendition:
             try:
-                # Create a temporary WAV file
-                wav_filename = os.path.splitext(song.file_path)[0] + '.wav'
-                output_path = os.path.join(uploads_dir, wav_filename)
-                
-                logger.debug(f"Converting to WAV: {output_path}")
-                
-                # Use ffmpeg to convert to WAV
-                command = [
-                    'ffmpeg', '-y',  # -y to overwrite output file
-                    '-i', source_path,
-                    '-acodec', 'pcm_s16le',  # Standard WAV format
-                    '-ar', '44100',  # Standard sample rate
-                    output_path
-                ]
-                
-                logger.debug(f"Running ffmpeg command: {' '.join(command)}")
-                process = subprocess.run(
-                    command,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
+                cache = get_rendition_cache()
+                key = rendition_key(song.sha256 or source_hash(source_path), rendition)
+                download_name = f"{song.title}.{rendition['ext']}"
+                user_id = str(current_user._id)
+                logger.debug(f"Looking up {requested_format} rendition: {key}")
+
+                output_path = cache.get(key)
+
+                # On a miss, stream the rendition while ffmpeg fills the cache, or join
+                # a fill already streaming. Clients asking for a byte range other than
+                # "from the start" wait for the finished file instead
+                whole = request.range is None or request.range.ranges == [(0, None)]
+                if not output_path and STREAM_TRANSCODE and whole:
+                    body = follow_fill(key)
+                    if body is None:
+                        pending = cache.begin(key, rendition['ext'])
+                        if pending:
+                            try:
+                                slot = transcode_scheduler.acquire(user_id)
+                            except QueueFull:
+                                pending.abort()
+                                raise
+                            logger.debug(f"Streaming {requested_format} transcode for {key}")
+                            # The slot is held until ffmpeg is done, however slowly clients read
+                            fill = StreamingFill(key, source_path, rendition, pending, on_done=slot.release)
+                            body = fill.follow()
+                            if body is None:
+                                # Already finished (or failed); the cache has the answer
+                                output_path = cache.get(key)
+                    if body is not None:
+                        return stream_audio(body, download_name, rendition['mimetype'], inline=inline)
+
+                # Concurrent requests for the same rendition share one conversion
+                if not output_path:
+                    def produce(temp_path):
+                        with transcode_scheduler.acquire(user_id):
+                            transcode_file(source_path, rendition, temp_path)
+
+                    output_path = cache.fill(key, rendition['ext'], produce, timeout=TRANSCODE_WAIT_TIMEOUT)
+                logger.debug(f"Serving rendition from cache: {output_path}")
+
+                return send_audio(
+                    output_path,
+                    download_name,
+                    mimetype=rendition['mimetype'],
+                    inline=inline
                 )
-                
-                if process.returncode != 0:
-                    error_output = process.stderr.decode()
-                    logger.error(f"FFmpeg conversion failed: {error_output}")
-                    return jsonify({'message': 'Conversion failed'}), 500
-                
-                logger.debug("Conversion successful")
-                
-                # Send the WAV file
-                @after_this_request
-                def cleanup(response):
-                    try:
-                        if os.path.exists(output_path):
-                            os.remove(output_path)
-                            logger.debug(f"Cleaned up temporary WAV file: {output_path}")
-                    except Exception as e:
-                        logger.error(f"Error cleaning up WAV file: {str(e)}")
-                    return response
-                
-                return send_file(output_path, mimetype='audio/wav', as_attachment=True, download_name=f"{song.title}.wav")
-            
+
+            except QueueFull as e:
+                logger.warning(f"Transcoding busy, asking client to retry in {e.retry_after}s")
+                response = jsonify({'message': 'Server is busy converting other songs, please retry shortly'})
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response, 503
+            except TimeoutError as e:
+                logger.warning(f"Gave up waiting for {requested_format} rendition: {str(e)}")
+                response = jsonify({'message': 'Song is still being converted, please retry shortly'})
+                response.headers['Retry-After'] = '5'
+                return response, 503
+            except TranscodeError:
+                return jsonify({'message': 'Conversion failed'}), 500
             except Exception as e:
-                logger.error(f"Error during WAV conversion: {str(e)}")
+                logger.error(f"Error during {requested_format} conversion: {str(e)}")
                 return jsonify({'message': f'Conversion failed: {str(e)}'}), 500
         
         # Unsupported format
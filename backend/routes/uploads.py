@@ -0,0 +1,183 @@
+from flask import Blueprint, request, jsonify
+from auth.auth import token_required
+from utils.ingest import IngestError, ingest_stream
+from utils.library import ALLOWED_EXTENSIONS, add_song_from_blob, add_uploaded_song, allowed_file
+from utils.storage import get_uploads_dir
+from werkzeug.utils import secure_filename
+from utils.uploads import UploadSessions, UploadSessionError, MAX_RESUMABLE_UPLOAD_BYTES
+import os
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+uploads = Blueprint('uploads', __name__)
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+_sessions = None
+_sessions_lock = threading.Lock()
+
+def get_sessions():
+    global _sessions
+    with _sessions_lock:
+        if _sessions is None:
+            _sessions = UploadSessions(os.path.join(get_uploads_dir(), '.sessions'))
+        return _sessions
+
+@uploads.route('/api/songs/upload/check', methods=['POST'])
+@token_required
+def check_upload(current_user):
+    """Create the song straight away if we already hold a file with this hash and size"""
+    try:
+        data = request.get_json()
+        logger.debug(f"Upload pre-check request: {data}")
+
+        if not data or not data.get('sha256') or not data.get('size') or not data.get('filename'):
+            return jsonify({'message': 'sha256, size and filename are required'}), 400
+
+        sha256 = str(data['sha256']).lower()
+        if not SHA256_PATTERN.match(sha256):
+            return jsonify({'message': 'sha256 must be 64 hex characters'}), 400
+
+        if not allowed_file(data['filename']):
+            return jsonify({'message': 'Invalid file type'}), 400
+
+        new_song = add_song_from_blob(
+            current_user._id,
+            sha256,
+            int(data['size']),
+            title=data.get('title') or secure_filename(data['filename'])
+        )
+        if not new_song:
+            logger.debug(f"Blob {sha256} not stored yet, client must upload it")
+            return jsonify({'exists': False}), 200
+
+        return jsonify({
+            'exists': True,
+            'message': 'Song uploaded successfully',
+            'song': new_song.to_dict()
+        }), 201
+
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid pre-check parameters: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"Failed upload pre-check: {str(e)}")
+        return jsonify({'message': f'Failed to check upload: {str(e)}'}), 500
+
+@uploads.route('/api/songs/upload/sessions', methods=['POST'])
+@token_required
+def create_upload_session(current_user):
+    try:
+        data = request.get_json()
+        logger.debug(f"Create upload session request: {data}")
+
+        if not data or not data.get('filename') or not data.get('size'):
+            return jsonify({'message': 'filename and size are required'}), 400
+
+        if not allowed_file(data['filename']):
+            return jsonify({'message': 'Invalid file type'}), 400
+
+        session = get_sessions().create(
+            current_user._id,
+            data['filename'],
+            data['size'],
+            chunk_size=data.get('chunk_size'),
+            title=data.get('title'),
+            sha256=data.get('sha256')
+        )
+        return jsonify(get_sessions().status(session)), 201
+
+    except UploadSessionError as e:
+        return jsonify({'message': str(e)}), e.status
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid upload session parameters: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"Failed to create upload session: {str(e)}")
+        return jsonify({'message': f'Failed to create upload session: {str(e)}'}), 500
+
+@uploads.route('/api/songs/upload/sessions/<session_id>', methods=['GET'])
+@token_required
+def get_upload_session(current_user, session_id):
+    try:
+        session = get_sessions().get(session_id, current_user._id)
+        return jsonify(get_sessions().status(session))
+    except UploadSessionError as e:
+        return jsonify({'message': str(e)}), e.status
+    except Exception as e:
+        logger.error(f"Failed to fetch upload session {session_id}: {str(e)}")
+        return jsonify({'message': f'Failed to fetch upload session: {str(e)}'}), 500
+
+@uploads.route('/api/songs/upload/sessions/<session_id>/chunks/<int:index>', methods=['PUT'])
+@token_required
+def put_upload_chunk(current_user, session_id, index):
+    try:
+        sessions = get_sessions()
+        session = sessions.get(session_id, current_user._id)
+
+        # The raw request body is the chunk; an optional SHA-256 guards against corruption
+        sessions.put_chunk(session, index, request.stream, checksum=request.headers.get('X-Chunk-SHA256'))
+        logger.debug(f"Stored chunk {index} of upload session {session_id}")
+
+        return jsonify({'id': session_id, 'index': index, 'stored': True})
+    except UploadSessionError as e:
+        return jsonify({'message': str(e)}), e.status
+    except Exception as e:
+        logger.error(f"Failed to store chunk {index} of {session_id}: {str(e)}")
+        return jsonify({'message': f'Failed to store chunk: {str(e)}'}), 500
+
+@uploads.route('/api/songs/upload/sessions/<session_id>/complete', methods=['POST'])
+@token_required
+def complete_upload_session(current_user, session_id):
+    ingested = None
+    try:
+        sessions = get_sessions()
+        session = sessions.get(session_id, current_user._id)
+
+        # Reassemble the chunks through the same sniff/hash/size checks as a direct upload
+        reader = sessions.open_chunks(session)
+        try:
+            ingested = ingest_stream(
+                reader,
+                get_uploads_dir(),
+                MAX_RESUMABLE_UPLOAD_BYTES,
+                allowed_formats=ALLOWED_EXTENSIONS
+            )
+        finally:
+            reader.close()
+
+        if session.get('sha256') and ingested.sha256 != session['sha256']:
+            ingested.discard()
+            return jsonify({'message': 'Uploaded file does not match the declared sha256'}), 422
+
+        new_song = add_uploaded_song(current_user._id, ingested, session['filename'], session.get('title'))
+        sessions.delete(session_id)
+        logger.debug(f"Completed upload session {session_id} as song {new_song._id}")
+
+        return jsonify({
+            'message': 'Song uploaded successfully',
+            'song': new_song.to_dict()
+        }), 201
+
+    except (UploadSessionError, IngestError) as e:
+        return jsonify({'message': str(e)}), e.status
+    except Exception as e:
+        if ingested:
+            ingested.discard()
+        logger.error(f"Failed to complete upload session {session_id}: {str(e)}")
+        return jsonify({'message': f'Failed to upload song: {str(e)}'}), 500
+
+@uploads.route('/api/songs/upload/sessions/<session_id>', methods=['DELETE'])
+@token_required
+def abort_upload_session(current_user, session_id):
+    try:
+        sessions = get_sessions()
+        sessions.get(session_id, current_user._id)
+        sessions.delete(session_id)
+        return jsonify({'message': 'Upload session deleted'})
+    except UploadSessionError as e:
+        return jsonify({'message': str(e)}), e.status
+    except Exception as e:
+        logger.error(f"Failed to delete upload session {session_id}: {str(e)}")
+        return jsonify({'message': f'Failed to delete upload session: {str(e)}'}), 500
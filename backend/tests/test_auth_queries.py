@@ -0,0 +1,52 @@
+"""Round trips to MongoDB on the auth routes.
+
+Needs a real database: set MONGO_URI (or MONGODB_URI) to a disposable one.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+if not (os.getenv('MONGO_URI') or os.getenv('MONGODB_URI')):
+    pytest.skip('MONGO_URI is not set', allow_module_level=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from database import assert_max_queries, db
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def credentials():
+    name = f"test-{uuid.uuid4().hex[:12]}"
+    credentials = {'username': name, 'email': f"{name}@example.com", 'password': 'correct horse battery'}
+    yield credentials
+    db.users.delete_many({'username': name})
+
+def test_register_is_one_write(client, credentials):
+    with assert_max_queries(1):
+        response = client.post('/api/auth/register', json=credentials)
+    assert response.status_code == 201
+
+def test_duplicate_register_is_one_write(client, credentials):
+    client.post('/api/auth/register', json=credentials)
+    with assert_max_queries(1):
+        response = client.post('/api/auth/register', json={**credentials, 'email': f"other-{credentials['email']}"})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Username already exists'
+
+def test_login_reads_the_user_once(client, credentials):
+    client.post('/api/auth/register', json=credentials)
+    # One read, plus one write if the stored hash needs upgrading
+    with assert_max_queries(2):
+        response = client.post('/api/auth/login', json={
+            'username': credentials['username'],
+            'password': credentials['password']
+        })
+    assert response.status_code == 200
@@ -1,7 +1,8 @@
-from pydub import AudioSegment
 import os
 from flask import current_app
-import magic
+from utils.probe import probe_audio
+from utils.ingest import sniff_format
+from utils.transcode import RENDITIONS, transcode_file
 
 def convert_to_wav(mp3_path):
     """Convert MP3 file to WAV format"""
@@ -13,9 +14,8 @@ def convert_to_wav(mp3_path):
         # Ensure WAV directory exists
         os.makedirs(os.path.dirname(wav_path), exist_ok=True)
         
-        # Load MP3 and export as WAV
-        audio = AudioSegment.from_mp3(mp3_path)
-        audio.export(wav_path, format='wav')
+        # Let ffmpeg do the conversion instead of decoding into memory
+        transcode_file(mp3_path, RENDITIONS['wav'], wav_path)
         
         return wav_path
     except Exception as e:
@@ -23,26 +23,27 @@ def convert_to_wav(mp3_path):
         return None
 
 def validate_audio_file(file):
-    """Validate that the uploaded file is an MP3"""
+    """Validate that the uploaded file is an MP3, WAV or OGG from its first few KB"""
     try:
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_buffer(file.read())
+        audio_format, _ = sniff_format(file.read)
         file.seek(0)  # Reset file pointer
         
-        if file_type != 'audio/mpeg':
-            return False, "File must be an MP3"
+        if audio_format is None:
+            return False, "File must be an MP3, WAV or OGG"
         
         return True, None
     except Exception as e:
         return False, str(e)
 
 def get_audio_metadata(file_path):
-    """Extract metadata from audio file"""
+    """Extract metadata from audio file headers without decoding it"""
     try:
-        audio = AudioSegment.from_mp3(file_path)
+        metadata = probe_audio(file_path)
+        if not metadata:
+            return None
         return {
-            'duration': len(audio) // 1000,  # Convert to seconds
-            'bitrate': audio.frame_rate * audio.sample_width * 8 * audio.channels
+            **metadata,
+            'duration': int(round(metadata['duration']))  # Whole seconds, like Spotify imports
         }
     except Exception as e:
         current_app.logger.error(f"Error extracting metadata: {str(e)}")
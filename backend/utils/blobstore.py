@@ -0,0 +1,111 @@
+from database import db
+from pymongo import ReturnDocument
+from datetime import datetime
+from utils.storage import resolve_path, sharded_path
+import os
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BlobStore:
+    """Audio files stored once per content hash, reference-counted in db.blobs.
+
+    A blob's id is the SHA-256 of its bytes. Every song pointing at a blob
+    holds one reference; the file is unlinked when the last one is dropped.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def filename_for(self, blob_id, ext):
+        """Path of a blob relative to the store root (what songs keep in file_path)"""
+        return f"{blob_id}.{ext}"
+
+    def path_for(self, blob_id, ext):
+        """Where a blob is stored (sharded, or still flat if not migrated yet)"""
+        return resolve_path(self.root, self.filename_for(blob_id, ext))
+
+    def get(self, blob_id):
+        return db.blobs.find_one({'_id': blob_id})
+
+    def put(self, source_path, blob_id, size, ext):
+        """Add a reference to blob_id, moving source_path into place if we don't hold it yet.
+
+        source_path is consumed either way. Returns the blob document.
+        """
+        final_path = self.path_for(blob_id, ext)
+        exists = os.path.exists(final_path)
+        before = db.blobs.find_one_and_update(
+            {'_id': blob_id},
+            {
+                '$inc': {'refcount': 1},
+                '$setOnInsert': {'size': size, 'ext': ext, 'created_at': datetime.utcnow()}
+            },
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+        # A blob that was new, being deleted, or lost from disk gets (re)published
+        if before is None or before.get('refcount', 0) <= 0 or not exists:
+            if not exists:
+                # New files always go into the sharded layout
+                final_path = sharded_path(self.root, self.filename_for(blob_id, ext))
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(source_path, final_path)
+            logger.debug(f"Stored new blob {blob_id} ({size} bytes)")
+        else:
+            os.remove(source_path)
+            logger.debug(f"Blob {blob_id} already stored, now {before['refcount'] + 1} references")
+
+        return before or {'_id': blob_id, 'size': size, 'ext': ext, 'refcount': 0}
+
+    def incref(self, blob_id):
+        """Add a reference to an existing blob; None if we don't have it"""
+        blob = db.blobs.find_one_and_update(
+            {'_id': blob_id, 'refcount': {'$gt': 0}},
+            {'$inc': {'refcount': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob and not os.path.exists(self.path_for(blob_id, blob['ext'])):
+            # Document survived but the file didn't; undo and treat as missing
+            self.decref(blob_id)
+            return None
+        return blob
+
+    def decref(self, blob_id):
+        """Drop a reference, unlinking the file when it was the last one"""
+        blob = db.blobs.find_one_and_update(
+            {'_id': blob_id},
+            {'$inc': {'refcount': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not blob:
+            logger.warning(f"decref of unknown blob {blob_id}")
+            return
+        if blob['refcount'] > 0:
+            logger.debug(f"Blob {blob_id} still has {blob['refcount']} references")
+            return
+
+        # Move the file aside first so a concurrent put() that revives the blob
+        # can republish it; only delete it for good once the document is gone
+        final_path = self.path_for(blob_id, blob['ext'])
+        trash_path = os.path.join(os.path.dirname(final_path), f".{blob_id}.{uuid.uuid4().hex}.deleting")
+        try:
+            os.replace(final_path, trash_path)
+        except FileNotFoundError:
+            trash_path = None
+
+        result = db.blobs.delete_one({'_id': blob_id, 'refcount': {'$lte': 0}})
+        if result.deleted_count:
+            if trash_path:
+                os.remove(trash_path)
+            logger.debug(f"Deleted blob {blob_id}")
+        elif trash_path:
+            # Someone took a new reference meanwhile
+            if os.path.exists(final_path):
+                os.remove(trash_path)
+            else:
+                os.replace(trash_path, final_path)
+            logger.debug(f"Blob {blob_id} was revived during delete")
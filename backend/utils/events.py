@@ -0,0 +1,225 @@
+from database import db
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from pymongo import CursorType
+from utils.metrics import metrics
+import os
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Most progress writes per second for one job
+JOB_EVENTS_PER_SECOND = float(os.getenv('JOB_EVENTS_PER_SECOND', '4'))
+
+# Imports go through metadata, search, download, postprocess and saved (or failed).
+# Stages after which nothing more is published for a job (or a track of it)
+FINAL_STAGES = ('saved', 'failed')
+
+class ProgressPublisher:
+    """Coalesced job progress events, written to the capped db.job_events collection.
+
+    Events for a job are held back so that it is written at most
+    max_rate times per second; a newer event for the same track replaces
+    the one waiting, so a burst of download ticks costs one write. Events
+    for different tracks of a job go out together in one insert_many.
+    Final stages are written straight away. Publishing never raises, an
+    import must not fail because its progress couldn't be reported.
+    """
+
+    def __init__(self, collection, max_rate=JOB_EVENTS_PER_SECOND):
+        self.collection = collection
+        self.interval = 1.0 / max_rate
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def publish(self, job, stage, track=None, **data):
+        event = {
+            'job_id': job['_id'],
+            'user_id': job['user_id'],
+            'stage': stage,
+            'track': track,
+            **data,
+            'created_at': datetime.utcnow()
+        }
+        with self._lock:
+            state = self._jobs.setdefault(job['_id'], {'last': 0.0, 'pending': OrderedDict(), 'timer': None})
+            state['pending'].pop(track, None)
+            state['pending'][track] = event
+            if stage in FINAL_STAGES and track is None:
+                flush_now = True
+            else:
+                wait = state['last'] + self.interval - time.monotonic()
+                flush_now = wait <= 0 and state['timer'] is None
+                if not flush_now and state['timer'] is None:
+                    state['timer'] = threading.Timer(wait, self.flush, args=(job['_id'],))
+                    state['timer'].daemon = True
+                    state['timer'].start()
+        if flush_now:
+            self.flush(job['_id'], final=stage in FINAL_STAGES and track is None)
+
+    def flush(self, job_id, final=False):
+        """Write whatever is waiting for a job; final also forgets the job"""
+        with self._lock:
+            state = self._jobs.get(job_id)
+            if state is None:
+                return
+            events = list(state['pending'].values())
+            state['pending'].clear()
+            state['last'] = time.monotonic()
+            if state['timer'] is not None:
+                state['timer'].cancel()
+                state['timer'] = None
+            if final:
+                del self._jobs[job_id]
+        if not events:
+            return
+        try:
+            self.collection.insert_many(events, ordered=False)
+            metrics.incr('job_events.written', len(events))
+        except Exception as e:
+            logger.error(f"Failed to publish progress for job {job_id}: {str(e)}")
+
+class EventTail:
+    """One tailable cursor over db.job_events per process, fanned out to streams by user.
+
+    A tailable cursor filtered for one user dies whenever nothing matches
+    and has to be reopened, rescanning the capped collection each time.
+    This one reads every event, so it stays open while the collection has
+    anything in it. When it does die (it fell behind and was overwritten,
+    or the connection dropped) it's reopened from the last event seen,
+    minus REOPEN_SLACK seconds for clocks of other processes that run
+    behind; events already handed out are skipped by id.
+    """
+
+    REOPEN_SLACK = 5
+    # Events a slow stream may have waiting before it's cut off (the client reconnects)
+    MAX_PENDING = 1000
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._thread = None
+        self._seen = deque(maxlen=10000)
+        self._seen_ids = set()
+
+        metrics.gauge('job_events.streams', lambda: sum(len(queues) for queues in list(self._subscribers.values())))
+
+    def subscribe(self, user_id):
+        """A queue that receives the user's new events, None once it fell too far behind"""
+        events = queue.Queue(maxsize=self.MAX_PENDING + 1)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(events)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(events)
+                if not queues:
+                    del self._subscribers[user_id]
+
+    def _remember(self, event_id):
+        if len(self._seen) == self._seen.maxlen:
+            self._seen_ids.discard(self._seen[0])
+        self._seen.append(event_id)
+        self._seen_ids.add(event_id)
+
+    def _dispatch(self, event):
+        with self._lock:
+            queues = list(self._subscribers.get(event['user_id'], ()))
+        for events in queues:
+            if events.qsize() >= self.MAX_PENDING:
+                # Not keeping up: end its stream rather than hold events for it forever
+                self.unsubscribe(event['user_id'], events)
+                events.put_nowait(None)
+                metrics.incr('job_events.streams_dropped')
+                continue
+            events.put_nowait(event)
+
+    def _run(self):
+        since = None
+        while True:
+            try:
+                if since is None:
+                    # Start at the newest event; what's already there isn't news
+                    latest = self.collection.find_one(sort=[('$natural', -1)])
+                    if latest:
+                        since = latest['created_at'] - timedelta(seconds=self.REOPEN_SLACK)
+                        for old in self.collection.find({'created_at': {'$gte': since}}, {'_id': 1}):
+                            self._remember(old['_id'])
+                query = {'created_at': {'$gte': since}} if since else {}
+                cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for event in cursor:
+                        if event['_id'] in self._seen_ids:
+                            continue
+                        self._remember(event['_id'])
+                        mark = event['created_at'] - timedelta(seconds=self.REOPEN_SLACK)
+                        since = max(since, mark) if since else mark
+                        self._dispatch(event)
+            except Exception as e:
+                logger.error(f"Error tailing job events: {str(e)}")
+            # Dead cursor, e.g. on an empty collection; reopen it after a moment
+            time.sleep(1)
+
+def replay_events(user_id, job_id=None, after=None):
+    """Events already written: all of a job's, and/or the user's since the event after.
+
+    Ordered by created_at rather than _id: events come from several
+    processes, whose ObjectIds don't sort in the order they were written.
+    """
+    query = {'user_id': user_id}
+    if job_id:
+        query['job_id'] = job_id
+    if after:
+        last = db.job_events.find_one({'_id': after, 'user_id': user_id}, {'created_at': 1})
+        if last is None:
+            # Gone from the capped collection (or never ours); nothing to go on
+            return []
+        query['created_at'] = {'$gte': last['created_at']}
+        query['_id'] = {'$ne': after}
+    elif not job_id:
+        return []
+    return db.job_events.find(query).sort('created_at', 1)
+
+def follow_events(user_id, job_id=None, after=None, keepalive=15):
+    """Yield a user's job events as they're written, oldest first.
+
+    With job_id only that job's events, starting with those it already
+    published; with after (an event id) the ones since that event first.
+    Yields None every keepalive seconds without events, so callers can
+    ping the client and notice it went away. Returns if the client fell
+    too far behind; it can reconnect with the last id it saw.
+    """
+    user_id = str(user_id)
+    # Subscribe before replaying so nothing written in between is missed
+    events = event_tail.subscribe(user_id)
+    try:
+        replayed = set()
+        for event in replay_events(user_id, job_id, after):
+            replayed.add(event['_id'])
+            yield event
+        while True:
+            try:
+                event = events.get(timeout=keepalive)
+            except queue.Empty:
+                yield None
+                continue
+            if event is None:
+                return
+            if event['_id'] in replayed or (job_id and event['job_id'] != job_id):
+                continue
+            yield event
+    finally:
+        event_tail.unsubscribe(user_id, events)
+
+progress = ProgressPublisher(db.job_events)
+event_tail = EventTail(db.job_events)
@@ -0,0 +1,241 @@
+from flask import current_app
+from utils.spotify import SpotifyDownloader
+from utils.spotify_cache import match_cache, track_cache
+from utils.ingest import ingest_file
+from utils.events import progress
+from utils.jobs import job_queue
+from utils.resilience import CircuitOpen
+from utils.library import insert_song, insert_songs, prepare_song, prepare_song_from_blob
+from utils.scheduler import FairScheduler
+from utils.singleflight import download_flights
+from utils.slots import download_slots
+from utils.storage import get_uploads_dir
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import shutil
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SPOTIFY_IMPORT = 'spotify_import'
+SPOTIFY_COLLECTION_IMPORT = 'spotify_collection_import'
+
+# Tracks of one album/playlist downloaded at the same time
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', '4'))
+# Largest album/playlist we'll import in one go
+MAX_COLLECTION_TRACKS = int(os.getenv('MAX_COLLECTION_TRACKS', '500'))
+# Seconds between progress writes to the job document
+PROGRESS_INTERVAL = 2.0
+
+# Downloads running at once, and per user. download_slots enforces both caps
+# across every worker process; download_scheduler decides, within a process,
+# who asks for a shared slot next: round-robin between users, and
+# single-track imports four times as often as album/playlist tracks
+DOWNLOAD_SLOTS = int(os.getenv('DOWNLOAD_SLOTS', '4'))
+DOWNLOAD_QUEUE_TIMEOUT = float(os.getenv('DOWNLOAD_QUEUE_TIMEOUT', '1800'))
+download_scheduler = FairScheduler(
+    'downloads',
+    slots=DOWNLOAD_SLOTS,
+    max_queue=int(os.getenv('DOWNLOAD_QUEUE_SIZE', '1000')),
+    queue_timeout=DOWNLOAD_QUEUE_TIMEOUT,
+    per_user=int(os.getenv('DOWNLOAD_SLOTS_PER_USER', '2')),
+    weights={'interactive': 4, 'bulk': 1}
+)
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+def get_downloader():
+    """Process-wide SpotifyDownloader; its clients, token and YoutubeDL pools are reused by every import"""
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = SpotifyDownloader(
+                client_id=os.getenv('SPOTIFY_CLIENT_ID'),
+                client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
+                cache=track_cache,
+                matches=match_cache,
+                staging_dir=os.path.join(get_uploads_dir(), '.staging', str(os.getpid())),
+                pool_size=IMPORT_CONCURRENCY
+            )
+        return _downloader
+
+def song_fields(track_info):
+    """Song fields from Spotify metadata; Spotify's duration wins, the file tells us the rest"""
+    return {
+        'title': track_info['title'],
+        'artist': track_info['artist'],
+        'album': track_info['album'],
+        'duration': track_info['duration'],
+        'cover_art': track_info['cover_art']
+    }
+
+def downloaded_file(download_dir, track_info):
+    """Path of a finished download, checking it actually exists"""
+    file_path = os.path.join(download_dir, track_info['file_path'])
+    if not os.path.exists(file_path):
+        raise Exception('Failed to download track: File not found')
+    return file_path
+
+def fetch_song(user_id, track_info, downloader, uploads_dir, on_progress=None, priority='interactive'):
+    """A prepared (not yet inserted) song for a Spotify track.
+
+    Only one download per track runs at a time, across threads and worker
+    processes; everyone else waiting on it attaches their song to the blob
+    the leader stored. on_progress gets the leader's download progress.
+    The download itself waits for a download_scheduler slot.
+    """
+    fields = song_fields(track_info)
+
+    def lead():
+        # Download into a private directory so nothing else writes to our file
+        download_dir = tempfile.mkdtemp(dir=uploads_dir, prefix='.download-')
+        try:
+            with download_scheduler.acquire(user_id, priority=priority), \
+                    download_slots.acquire(user_id, timeout=DOWNLOAD_QUEUE_TIMEOUT):
+                downloaded = downloader.download(track_info, download_dir, on_progress=on_progress)
+            logger.debug(f"Track info received: {downloaded}")
+            new_song = prepare_song(user_id, ingest_file(downloaded_file(download_dir, downloaded)), **fields)
+        finally:
+            # Clean up anything left of the download
+            shutil.rmtree(download_dir, ignore_errors=True)
+        return new_song, {'blob_id': new_song.blob_id, 'size': new_song.size}
+
+    def follow(shared):
+        return prepare_song_from_blob(user_id, shared['blob_id'], shared['size'], **fields)
+
+    return download_flights.run(f"spotify:{track_info['spotify_id']}", lead, follow)
+
+def import_spotify_track(job, downloader):
+    """Download one Spotify track via YouTube and add it to the user's library"""
+    spotify_url = job['payload']['url']
+    logger.debug(f"Job {job['_id']}: importing {spotify_url}")
+    progress.publish(job, 'metadata')
+    track_info = downloader.get_track_info(spotify_url)
+
+    def on_progress(stage, **data):
+        progress.publish(job, stage, **data)
+
+    # Store it by content hash and create the song record in MongoDB
+    new_song = insert_song(fetch_song(job['user_id'], track_info, downloader, get_uploads_dir(), on_progress))
+    logger.debug(f"Job {job['_id']}: song saved with ID {new_song._id} (blob {new_song.blob_id})")
+    progress.publish(job, 'saved', song_id=new_song._id, title=new_song.title)
+    return {'song': new_song.to_dict()}
+
+def import_spotify_collection(job, downloader):
+    """Import every track of a Spotify album or playlist.
+
+    Tracks download IMPORT_CONCURRENCY at a time and are inserted with a single
+    insert_many at the end. Per-track status is written to the job as it goes;
+    tracks that fail are reported without failing the whole import.
+
+    If Spotify or YouTube's circuit opens midway, the tracks done so far are
+    saved and remembered in the payload, and CircuitOpen is raised so the job
+    is deferred; when it runs again it carries on with the rest.
+    """
+    spotify_url = job['payload']['url']
+    progress.publish(job, 'metadata')
+    tracks = downloader.get_collection_tracks(spotify_url)
+    if not tracks:
+        raise Exception('No playable tracks found')
+    if len(tracks) > MAX_COLLECTION_TRACKS:
+        logger.warning(f"Job {job['_id']}: {len(tracks)} tracks, importing the first {MAX_COLLECTION_TRACKS}")
+        tracks = tracks[:MAX_COLLECTION_TRACKS]
+
+    # Saved by an earlier run of this job that was deferred, spotify_id -> song_id
+    saved_before = job['payload'].get('saved_tracks', {})
+    statuses = [{
+        'spotify_id': track['spotify_id'],
+        'title': track['title'],
+        'artist': track['artist'],
+        'status': 'saved' if track['spotify_id'] in saved_before else 'queued',
+        'song_id': saved_before.get(track['spotify_id']),
+        'error': None
+    } for track in tracks]
+
+    def summary():
+        counts = {}
+        for status in statuses:
+            counts[status['status']] = counts.get(status['status'], 0) + 1
+        return {'total': len(statuses), 'counts': counts, 'tracks': [dict(status) for status in statuses]}
+
+    # Worker threads don't inherit the app context
+    app = current_app._get_current_object()
+    uploads_dir = get_uploads_dir()
+
+    def fetch(index, track_info):
+        statuses[index]['status'] = 'downloading'
+
+        def on_progress(stage, **data):
+            progress.publish(job, stage, track=track_info['spotify_id'], **data)
+
+        with app.app_context():
+            return fetch_song(job['user_id'], track_info, downloader, uploads_dir, on_progress, priority='bulk')
+
+    job_queue.set_progress(job, summary())
+    prepared = {}
+    circuit_open = None
+    last_report = time.monotonic()
+    with ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY) as pool:
+        futures = {
+            pool.submit(fetch, index, track): index
+            for index, track in enumerate(tracks)
+            if statuses[index]['status'] == 'queued'
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                prepared[index] = future.result()
+                statuses[index]['status'] = 'downloaded'
+            except CircuitOpen as e:
+                # Not this track's fault; leave it for when the job runs again
+                statuses[index]['status'] = 'queued'
+                if circuit_open is None:
+                    circuit_open = e
+                    for pending in futures:
+                        pending.cancel()
+            except Exception as e:
+                logger.error(f"Job {job['_id']}: track {statuses[index]['spotify_id']} failed: {str(e)}")
+                statuses[index].update(status='failed', error=str(e))
+                progress.publish(job, 'failed', track=statuses[index]['spotify_id'], error=str(e))
+
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                job_queue.set_progress(job, summary())
+                last_report = time.monotonic()
+
+    # One round trip for the whole batch
+    order = sorted(prepared)
+    inserted = {song._id for song in insert_songs([prepared[index] for index in order])}
+    for index in order:
+        if prepared[index]._id in inserted:
+            statuses[index].update(status='saved', song_id=prepared[index]._id)
+        else:
+            statuses[index].update(status='failed', error='Failed to save song')
+        progress.publish(job, statuses[index]['status'], track=statuses[index]['spotify_id'], song_id=statuses[index]['song_id'])
+
+    if circuit_open is not None:
+        job_queue.save_payload(job, saved_tracks={
+            status['spotify_id']: status['song_id'] for status in statuses if status['status'] == 'saved'
+        })
+        job_queue.set_progress(job, summary())
+        raise circuit_open
+
+    result = summary()
+    job_queue.set_progress(job, result)
+    saved = result['counts'].get('saved', 0)
+    logger.debug(f"Job {job['_id']}: saved {saved} of {len(tracks)} tracks")
+    if not saved:
+        raise Exception(f"All {len(tracks)} tracks failed to import")
+    progress.publish(job, 'saved', total=len(tracks), counts=result['counts'])
+    return result
+
+# Job type -> handler(job, downloader) returning the job result
+HANDLERS = {
+    SPOTIFY_IMPORT: import_spotify_track,
+    SPOTIFY_COLLECTION_IMPORT: import_spotify_collection,
+}
@@ -0,0 +1,111 @@
+from utils.probe import SCAN_BYTES, detect_format
+import hashlib
+import os
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+SNIFF_BYTES = 4 * 1024
+# Headerless MP3 may need more than SNIFF_BYTES to confirm a frame
+MAX_SNIFF_BYTES = SCAN_BYTES
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_MB', '100')) * 1024 * 1024
+
+class IngestError(Exception):
+    """Upload rejected; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class IngestedFile:
+    """An upload sitting in a temp file next to its destination, hashed and sniffed"""
+
+    def __init__(self, temp_path, sha256, size, audio_format):
+        self.temp_path = temp_path
+        self.sha256 = sha256
+        self.size = size
+        self.format = audio_format
+
+    def publish(self, path):
+        """Atomically move the upload into place"""
+        os.replace(self.temp_path, path)
+        self.temp_path = None
+        return path
+
+    def discard(self):
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+def sniff_format(read):
+    """Read the start of a file with read(n) and identify it; returns (format or None, bytes read).
+
+    Reads SNIFF_BYTES, and more (up to MAX_SNIFF_BYTES) only while the
+    format can't be told yet. Streams may return short reads.
+    """
+    head = b''
+    limit = SNIFF_BYTES
+    while True:
+        at_eof = False
+        while len(head) < limit:
+            chunk = read(limit - len(head))
+            if not chunk:
+                at_eof = True
+                break
+            head += chunk
+        audio_format = detect_format(head, at_eof=at_eof)
+        if audio_format or at_eof or limit >= MAX_SNIFF_BYTES:
+            return audio_format, head
+        limit = min(limit * 2, MAX_SNIFF_BYTES)
+
+def ingest_stream(stream, dest_dir, max_bytes=MAX_UPLOAD_BYTES, allowed_formats=None):
+    """Copy an upload stream to a temp file in dest_dir in fixed-size chunks.
+
+    The type is sniffed from the first few KB before anything is written, the
+    SHA-256 is computed as bytes arrive and the size limit is enforced as soon
+    as it is crossed, so memory use doesn't depend on the file size.
+    """
+    # Read until we have enough to recognise the format
+    audio_format, head = sniff_format(stream.read)
+    if not head:
+        raise IngestError('Empty file')
+    if audio_format is None or (allowed_formats and audio_format not in allowed_formats):
+        raise IngestError('File is not a supported audio file')
+
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dest_dir, prefix='.upload-', suffix='.tmp')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise IngestError(f'File is larger than {max_bytes // (1024 * 1024)} MB', 413)
+                digest.update(chunk)
+                out.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    logger.debug(f"Ingested {size} bytes of {audio_format} into {temp_path}")
+    return IngestedFile(temp_path, digest.hexdigest(), size, audio_format)
+
+def ingest_file(path):
+    """Hash and sniff a file that is already on disk, without copying it"""
+    with open(path, 'rb') as f:
+        audio_format, _ = sniff_format(f.read)
+        if audio_format is None:
+            raise IngestError('File is not a supported audio file')
+        f.seek(0)
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return IngestedFile(path, digest.hexdigest(), size, audio_format)
@@ -0,0 +1,233 @@
+from database import db
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from bson import ObjectId
+from utils.metrics import metrics
+from datetime import datetime, timedelta
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+# Times a job may be put aside for a service outage before it fails like any other error
+MAX_DEFERRALS = int(os.getenv('JOB_MAX_DEFERRALS', '10'))
+
+# Higher runs first: single-track imports someone is waiting on go ahead of bulk ones
+PRIORITIES = {'interactive': 10, 'bulk': 0}
+
+class JobQueue:
+    """Durable job queue in a Mongo collection.
+
+    Workers claim jobs with find_one_and_update and hold them under a lease
+    they keep extending with heartbeats. A job whose lease runs out (worker
+    crashed or hung) becomes claimable again while it has attempts left,
+    and is failed by fail_abandoned() once it hasn't.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def enqueue(self, job_type, user_id, payload, max_attempts=DEFAULT_MAX_ATTEMPTS, priority='interactive'):
+        now = datetime.utcnow()
+        job = {
+            '_id': str(ObjectId()),
+            'type': job_type,
+            'user_id': str(user_id),
+            'payload': payload,
+            'status': 'queued',
+            'priority': PRIORITIES[priority],
+            'attempts': 0,
+            'max_attempts': max_attempts,
+            'not_before': now,
+            'lease_owner': None,
+            'lease_until': None,
+            'progress': None,
+            'result': None,
+            'error': None,
+            'created_at': now,
+            'updated_at': now
+        }
+        self.collection.insert_one(job)
+        logger.debug(f"Enqueued {job_type} job {job['_id']} for user {user_id}")
+        return job
+
+    def get(self, job_id, user_id=None):
+        query = {'_id': job_id}
+        if user_id is not None:
+            query['user_id'] = str(user_id)
+        return self.collection.find_one(query)
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS, job_types=None):
+        """Atomically take the highest-priority, oldest runnable job, or None"""
+        now = datetime.utcnow()
+        query = {
+            '$or': [
+                {'status': 'queued', 'not_before': {'$lte': now}},
+                # Worker died holding it; only while attempts remain, see fail_abandoned()
+                {'status': 'running', 'lease_until': {'$lt': now}, '$expr': {'$lt': ['$attempts', '$max_attempts']}}
+            ]
+        }
+        if job_types:
+            query['type'] = {'$in': list(job_types)}
+
+        job = self.collection.find_one_and_update(
+            query,
+            {
+                '$set': {
+                    'status': 'running',
+                    'lease_owner': worker_id,
+                    'lease_until': now + timedelta(seconds=lease_seconds),
+                    'started_at': now,
+                    'updated_at': now
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('priority', DESCENDING), ('created_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if job:
+            logger.debug(f"Worker {worker_id} claimed job {job['_id']} (attempt {job['attempts']})")
+        return job
+
+    def fail_abandoned(self):
+        """Fail jobs whose worker died on their last attempt; claim() won't take them again"""
+        now = datetime.utcnow()
+        result = self.collection.update_many(
+            {'status': 'running', 'lease_until': {'$lt': now}, '$expr': {'$gte': ['$attempts', '$max_attempts']}},
+            {'$set': {
+                'status': 'failed',
+                'error': 'Worker stopped while running the job',
+                'lease_until': None,
+                'finished_at': now,
+                'updated_at': now
+            }}
+        )
+        if result.modified_count:
+            metrics.incr('jobs.abandoned', result.modified_count)
+            logger.error(f"Failed {result.modified_count} jobs whose worker stopped on their last attempt")
+        return result.modified_count
+
+    def heartbeat(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend the lease; False means another worker has taken the job over"""
+        now = datetime.utcnow()
+        result = self.collection.update_one(
+            {'_id': job['_id'], 'status': 'running', 'lease_owner': job['lease_owner']},
+            {'$set': {'lease_until': now + timedelta(seconds=lease_seconds), 'updated_at': now}}
+        )
+        return result.matched_count == 1
+
+    def set_progress(self, job, progress):
+        """Record partial progress on a running job; ignored once we've lost the lease"""
+        return self.collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner']},
+            {'$set': {'progress': progress, 'updated_at': datetime.utcnow()}}
+        ).matched_count == 1
+
+    def complete(self, job, result=None):
+        now = datetime.utcnow()
+        return self.collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner']},
+            {'$set': {
+                'status': 'succeeded',
+                'result': result,
+                'error': None,
+                'lease_until': None,
+                'finished_at': now,
+                'updated_at': now
+            }}
+        ).matched_count == 1
+
+    def fail(self, job, error, retry=True):
+        """Record a failure, requeueing with exponential backoff while attempts remain"""
+        now = datetime.utcnow()
+        if retry and job['attempts'] < job.get('max_attempts', DEFAULT_MAX_ATTEMPTS):
+            delay = 2 ** job['attempts'] * 15
+            update = {
+                'status': 'queued',
+                'error': error,
+                'not_before': now + timedelta(seconds=delay),
+                'lease_owner': None,
+                'lease_until': None,
+                'updated_at': now
+            }
+            logger.warning(f"Job {job['_id']} failed (attempt {job['attempts']}), retrying in {delay}s: {error}")
+        else:
+            update = {
+                'status': 'failed',
+                'error': error,
+                'lease_until': None,
+                'finished_at': now,
+                'updated_at': now
+            }
+            logger.error(f"Job {job['_id']} failed permanently: {error}")
+        return self.collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner']},
+            {'$set': update}
+        ).matched_count == 1
+
+    def defer(self, job, retry_after, error=None, count=True):
+        """Put a job back in the queue for retry_after seconds without using up an attempt.
+
+        For outages of a service the job depends on (an open circuit): the job
+        didn't fail, it couldn't run yet. Only MAX_DEFERRALS times per job,
+        see can_defer(), so an outage that never ends still fails it. With
+        count=False (the circuit is only waiting on its trial call) the
+        deferral isn't held against that limit.
+        """
+        now = datetime.utcnow()
+        logger.warning(f"Job {job['_id']} deferred for {retry_after}s: {error}")
+        return self.collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner']},
+            {
+                '$set': {
+                    'status': 'queued',
+                    'error': error,
+                    'not_before': now + timedelta(seconds=retry_after),
+                    'lease_owner': None,
+                    'lease_until': None,
+                    'updated_at': now
+                },
+                '$inc': {'attempts': -1, 'deferrals': 1 if count else 0}
+            }
+        ).matched_count == 1
+
+    def can_defer(self, job):
+        return job.get('deferrals', 0) < MAX_DEFERRALS
+
+    def save_payload(self, job, **fields):
+        """Merge fields into a job's payload, e.g. what a deferred job already got done"""
+        job['payload'].update(fields)
+        self.collection.update_one(
+            {'_id': job['_id'], 'lease_owner': job['lease_owner']},
+            {'$set': {f'payload.{key}': value for key, value in fields.items()}}
+        )
+
+    def depth(self, status, priority=None):
+        query = {'status': status}
+        if priority is not None:
+            query['priority'] = PRIORITIES[priority]
+        return self.collection.count_documents(query)
+
+def job_to_dict(job):
+    """Public view of a job for API responses"""
+    return {
+        'id': job['_id'],
+        'type': job['type'],
+        'status': job['status'],
+        'priority': job.get('priority', 0),
+        'attempts': job['attempts'],
+        'progress': job.get('progress'),
+        'result': job.get('result'),
+        'error': job.get('error'),
+        'created_at': job['created_at'].isoformat(),
+        'updated_at': job['updated_at'].isoformat(),
+        'finished_at': job['finished_at'].isoformat() if job.get('finished_at') else None
+    }
+
+job_queue = JobQueue(db.jobs)
+
+# Queue depth across all worker processes, read when /metrics is scraped
+for _priority in PRIORITIES:
+    metrics.gauge(f'jobs.queued.{_priority}', lambda priority=_priority: job_queue.depth('queued', priority))
+metrics.gauge('jobs.running', lambda: job_queue.depth('running'))
@@ -0,0 +1,166 @@
+from werkzeug.utils import secure_filename
+from models.models import Song
+from database import db
+from pymongo.errors import BulkWriteError
+from utils.probe import probe_audio
+from utils.blobstore import BlobStore
+from utils.storage import get_uploads_dir, locate
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg'}
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+def get_blob_store():
+    """Process-wide blob store rooted at the uploads dir"""
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore(get_uploads_dir())
+        return _blob_store
+
+def audio_fields(file_path):
+    """Song fields read from the audio headers (no decoding), empty if the file can't be probed"""
+    metadata = probe_audio(file_path)
+    if not metadata:
+        return {}
+    return {
+        'duration': int(round(metadata['duration'])),
+        'bitrate': metadata['bitrate'],
+        'sample_rate': metadata['sample_rate'],
+        'channels': metadata['channels'],
+        'codec': metadata['codec']
+    }
+
+def prepare_song(user_id, ingested, **fields):
+    """Store an ingested file as a blob and build a song record referencing it, without inserting it.
+
+    Identical files are stored once; the song only takes a reference. Fields
+    given by the caller (title, artist, duration...) override probed ones.
+    The caller must insert the song or release its blob reference.
+    """
+    store = get_blob_store()
+    blob_id = ingested.sha256
+    store.put(ingested.temp_path, blob_id, ingested.size, ingested.format)
+    ingested.temp_path = None
+
+    try:
+        file_path = store.filename_for(blob_id, ingested.format)
+
+        # Read duration, bitrate etc. from the file headers
+        metadata = audio_fields(store.path_for(blob_id, ingested.format))
+        logger.debug(f"Probed blob {blob_id}: {metadata}")
+
+        return Song(
+            file_path=file_path,
+            user_id=str(user_id),
+            blob_id=blob_id,
+            sha256=ingested.sha256,
+            size=ingested.size,
+            **{**metadata, **fields}
+        )
+    except Exception:
+        store.decref(blob_id)
+        raise
+
+def insert_song(new_song):
+    """Insert a prepared song, releasing its blob reference if that fails"""
+    try:
+        # Insert into MongoDB
+        db.songs.insert_one(new_song.to_dict())
+    except Exception:
+        get_blob_store().decref(new_song.blob_id)
+        raise
+    return new_song
+
+def add_song(user_id, ingested, **fields):
+    """Store an ingested file as a blob and create a song record referencing it"""
+    return insert_song(prepare_song(user_id, ingested, **fields))
+
+def insert_songs(songs):
+    """Insert prepared songs with a single insert_many; returns the ones that made it.
+
+    Songs the server rejected have their blob reference released. Other errors
+    propagate: we can't tell what was written, so references are left alone.
+    """
+    if not songs:
+        return []
+    failed = set()
+    try:
+        db.songs.insert_many([song.to_dict() for song in songs], ordered=False)
+    except BulkWriteError as e:
+        failed = {error['index'] for error in e.details.get('writeErrors', [])}
+        logger.error(f"{len(failed)} of {len(songs)} songs failed to insert")
+
+    store = get_blob_store()
+    for index in failed:
+        store.decref(songs[index].blob_id)
+    return [song for index, song in enumerate(songs) if index not in failed]
+
+def prepare_song_from_blob(user_id, blob_id, size, **fields):
+    """Build a song referencing a blob we already hold, without inserting it; None if we don't have it.
+
+    No bytes are transferred, the song just takes another reference.
+    """
+    store = get_blob_store()
+    blob = store.incref(blob_id)
+    if not blob:
+        return None
+    if blob['size'] != size:
+        # Same hash but a different size means the client's hash is wrong
+        store.decref(blob_id)
+        return None
+
+    try:
+        metadata = audio_fields(store.path_for(blob_id, blob['ext']))
+        return Song(
+            file_path=store.filename_for(blob_id, blob['ext']),
+            user_id=str(user_id),
+            blob_id=blob_id,
+            sha256=blob_id,
+            size=blob['size'],
+            **{**metadata, **fields}
+        )
+    except Exception:
+        store.decref(blob_id)
+        raise
+
+def add_song_from_blob(user_id, blob_id, size, **fields):
+    """Create a song referencing a blob we already hold; None if we don't have it"""
+    new_song = prepare_song_from_blob(user_id, blob_id, size, **fields)
+    if new_song is None:
+        return None
+    insert_song(new_song)
+    logger.debug(f"Created song {new_song._id} from existing blob {blob_id}")
+    return new_song
+
+def add_uploaded_song(user_id, ingested, original_filename, title=None):
+    """Create a song from an ingested upload"""
+    filename = secure_filename(original_filename)
+    return add_song(user_id, ingested, title=title or filename)
+
+def delete_song_file(song):
+    """Release a deleted song's file: drop its blob reference, or unlink a legacy file nobody else uses"""
+    if song.blob_id:
+        get_blob_store().decref(song.blob_id)
+        return
+
+    if db.songs.count_documents({'file_path': song.file_path}, limit=1):
+        logger.debug(f"Legacy file {song.file_path} still used by another song, keeping it")
+        return
+
+    file_path = locate(song.file_path)
+    logger.debug(f"Attempting to delete file: {file_path}")
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        logger.debug("File deleted successfully")
+    else:
+        logger.warning("File not found on disk")
@@ -0,0 +1,56 @@
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Metrics:
+    """Small in-process registry of counters, gauges and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, fn):
+        """Register a callable that is evaluated every time a snapshot is taken"""
+        with self._lock:
+            self._gauges[name] = fn
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['last'] = seconds
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {name: dict(timing) for name, timing in self._timings.items()}
+
+        gauge_values = {}
+        for name, fn in gauges.items():
+            try:
+                gauge_values[name] = fn()
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {str(e)}")
+                gauge_values[name] = None
+
+        for timing in timings.values():
+            timing['avg'] = timing['total'] / timing['count'] if timing['count'] else 0.0
+
+        return {
+            'counters': counters,
+            'gauges': gauge_values,
+            'timings': timings
+        }
+
+# Process-wide registry
+metrics = Metrics()
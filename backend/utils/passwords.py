@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from utils.metrics import metrics
+from utils.scheduler import QueueFull
+import math
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Password hashes computed at once per process; hashlib releases the GIL, so
+# this is roughly how many cores logins and signups may take
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', '32'))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT', '5'))
+# Any werkzeug method, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000. Stored
+# hashes made with other parameters are upgraded on the next login
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+
+class PasswordHasher:
+    """Password hashing on a small dedicated thread pool.
+
+    Keeps a burst of logins from taking every request thread's CPU: at most
+    workers hashes run at once, max_queue more may wait, and one that can't
+    start within queue_timeout seconds raises QueueFull instead.
+    """
+
+    def __init__(self, workers, max_queue, queue_timeout, method):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.method = method
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._avg_time = 0.1
+        self._prefix = None
+
+        metrics.gauge('passwords.pending', lambda: self._pending)
+
+    def retry_after(self):
+        return max(1, int(math.ceil((self._pending / self.workers + 1) * self._avg_time)))
+
+    def _run(self, name, fn, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                metrics.incr('passwords.rejected')
+                raise QueueFull('Too many password checks in progress', self.retry_after())
+            self._pending += 1
+
+        started = threading.Event()
+        enqueued = time.monotonic()
+
+        def work():
+            started.set()
+            metrics.observe('passwords.wait', time.monotonic() - enqueued)
+            begin = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                elapsed = time.monotonic() - begin
+                self._avg_time = 0.8 * self._avg_time + 0.2 * elapsed
+                metrics.observe(f'passwords.{name}', elapsed)
+
+        try:
+            future = self._pool.submit(work)
+            if not started.wait(self.queue_timeout) and future.cancel():
+                metrics.incr('passwords.timeouts')
+                raise QueueFull('Timed out waiting to check the password', self.retry_after())
+            return future.result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run('verify', check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Whether a stored hash was made with other parameters than self.method"""
+        if self._prefix is None:
+            # werkzeug fills in defaults ('scrypt' -> 'scrypt:32768:8:1'), so ask it
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+password_hasher = PasswordHasher(
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_HASH_QUEUE_SIZE,
+    PASSWORD_HASH_QUEUE_TIMEOUT,
+    PASSWORD_HASH_METHOD
+)
@@ -0,0 +1,329 @@
+import json
+import os
+import struct
+import subprocess
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How much of the file we look at to find the first MPEG frame
+SCAN_BYTES = 64 * 1024
+# How much of the tail we read to find the last Ogg page
+OGG_TAIL_BYTES = 64 * 1024
+
+# MPEG audio lookup tables, indexed by the values in the frame header
+MPEG_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+MPEG_LAYERS = {1: 3, 2: 2, 3: 1}
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+def detect_format(head, at_eof=False):
+    """Identify mp3/wav/ogg/m4a/webm from the first few KB of a file.
+
+    Headerless MP3 is only recognised from a frame confirmed by the next one,
+    so None may mean "read more"; at_eof says head is the whole file.
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'wav'
+    if head[:4] == b'OggS':
+        return 'ogg'
+    # MP4 family (AAC in m4a) and Matroska/WebM, as YouTube imports may be
+    if head[4:8] == b'ftyp':
+        return 'm4a'
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return 'webm'
+    if head[:3] == b'ID3':
+        return 'mp3'
+    offset = _find_mpeg_frame(head, 0, at_eof)
+    if offset is not None:
+        return 'mp3'
+    return None
+
+def _parse_mpeg_header(data, offset):
+    """Decode a 4-byte MPEG audio frame header, or None if it isn't one"""
+    if offset + 4 > len(data):
+        return None
+    header = struct.unpack('>I', data[offset:offset + 4])[0]
+    if header & 0xFFE00000 != 0xFFE00000:
+        return None
+
+    version = MPEG_VERSIONS.get((header >> 19) & 0x3)
+    layer = MPEG_LAYERS.get((header >> 17) & 0x3)
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 0x3
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = MPEG_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header >> 9) & 0x1
+    channels = 1 if (header >> 6) & 0x3 == 3 else 2
+
+    if layer == 1:
+        samples_per_frame = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or version == 1:
+        samples_per_frame = 1152
+        frame_length = 144 * bitrate // sample_rate + padding
+    else:
+        samples_per_frame = 576
+        frame_length = 72 * bitrate // sample_rate + padding
+
+    return {
+        'version': version,
+        'layer': layer,
+        'bitrate': bitrate,
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'samples_per_frame': samples_per_frame,
+        'frame_length': frame_length
+    }
+
+def _find_mpeg_frame(data, start, at_eof=False):
+    """Find the first frame header followed by a header of the same stream.
+
+    A candidate whose next frame lies past the end of data is rejected,
+    unless data is the whole file (at_eof) and the frame ends exactly there.
+    """
+    offset = data.find(b'\xff', start)
+    while offset != -1 and offset + 4 <= len(data):
+        frame = _parse_mpeg_header(data, offset)
+        if frame:
+            following = offset + frame['frame_length']
+            if at_eof and following == len(data):
+                return offset
+            after = _parse_mpeg_header(data, following)
+            if after and all(after[field] == frame[field] for field in ('version', 'layer', 'sample_rate')):
+                return offset
+        offset = data.find(b'\xff', offset + 1)
+    return None
+
+def _id3v2_size(head):
+    """Total size of a leading ID3v2 tag (header and optional footer included)"""
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in head[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+def probe_mp3(path):
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        # Skip any ID3v2 tags (there can be more than one, and they may hold cover art)
+        audio_start = 0
+        while True:
+            f.seek(audio_start)
+            tag_size = _id3v2_size(f.read(10))
+            if not tag_size:
+                break
+            audio_start += tag_size
+
+        f.seek(audio_start)
+        data = f.read(SCAN_BYTES)
+        offset = _find_mpeg_frame(data, 0, at_eof=audio_start + len(data) >= file_size)
+        if offset is None:
+            return None
+        frame = _parse_mpeg_header(data, offset)
+
+        audio_end = file_size
+        if file_size >= 128:
+            f.seek(file_size - 128)
+            if f.read(3) == b'TAG':
+                audio_end -= 128
+
+    frames = None
+    audio_bytes = None
+
+    # Xing/Info header sits after the side information of the first frame
+    if frame['version'] == 1:
+        side_info = 17 if frame['channels'] == 1 else 32
+    else:
+        side_info = 9 if frame['channels'] == 1 else 17
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+        position = xing + 8
+        if flags & 0x1:
+            frames = struct.unpack('>I', data[position:position + 4])[0]
+            position += 4
+        if flags & 0x2:
+            audio_bytes = struct.unpack('>I', data[position:position + 4])[0]
+
+    # VBRI header (Fraunhofer encoders) is at a fixed offset of 32 bytes
+    vbri = offset + 4 + 32
+    if frames is None and data[vbri:vbri + 4] == b'VBRI':
+        audio_bytes, frames = struct.unpack('>II', data[vbri + 10:vbri + 18])
+
+    if frames:
+        duration = frames * frame['samples_per_frame'] / frame['sample_rate']
+        if not audio_bytes:
+            audio_bytes = audio_end - audio_start - offset
+        bitrate = int(audio_bytes * 8 / duration) if duration else frame['bitrate']
+    else:
+        # Constant bitrate: the size of the audio data gives the duration
+        bitrate = frame['bitrate']
+        duration = (audio_end - audio_start - offset) * 8 / bitrate
+
+    return {
+        'codec': 'mp3',
+        'duration': duration,
+        'bitrate': bitrate,
+        'sample_rate': frame['sample_rate'],
+        'channels': frame['channels']
+    }
+
+def probe_wav(path):
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+
+        fmt = None
+        offset = 12
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+            if chunk_id == b'fmt ':
+                audio_format, channels, sample_rate, byte_rate = struct.unpack('<HHII', f.read(12))
+                fmt = (audio_format, channels, sample_rate, byte_rate)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    return None
+                data_size = chunk_size
+                # Streamed WAVs leave the size at 0 or 0xFFFFFFFF
+                if data_size in (0, 0xFFFFFFFF) or offset + 8 + data_size > file_size:
+                    data_size = file_size - offset - 8
+                audio_format, channels, sample_rate, byte_rate = fmt
+                return {
+                    'codec': 'pcm' if audio_format in (1, 0xFFFE) else f'wav_{audio_format}',
+                    'duration': data_size / byte_rate if byte_rate else 0,
+                    'bitrate': byte_rate * 8,
+                    'sample_rate': sample_rate,
+                    'channels': channels
+                }
+            offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+def probe_ogg(path):
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(512)
+        f.seek(max(0, file_size - OGG_TAIL_BYTES))
+        tail = f.read(OGG_TAIL_BYTES)
+
+    if head[:4] != b'OggS':
+        return None
+
+    # The first packet starts after the page header and its segment table
+    segments = head[26]
+    packet = head[27 + segments:]
+    pre_skip = 0
+    if packet[:7] == b'\x01vorbis':
+        channels = packet[11]
+        sample_rate, _, nominal_bitrate = struct.unpack('<Iii', packet[12:24])
+        codec = 'vorbis'
+        granule_rate = sample_rate
+    elif packet[:8] == b'OpusHead':
+        channels = packet[9]
+        pre_skip = struct.unpack('<H', packet[10:12])[0]
+        sample_rate = struct.unpack('<I', packet[12:16])[0] or 48000
+        nominal_bitrate = 0
+        codec = 'opus'
+        granule_rate = 48000  # Opus granule positions always count 48 kHz samples
+    else:
+        return None
+
+    # Duration comes from the granule position of the last page
+    duration = 0
+    last_page = tail.rfind(b'OggS')
+    if last_page != -1 and last_page + 14 <= len(tail):
+        granule = struct.unpack('<q', tail[last_page + 6:last_page + 14])[0]
+        if granule > 0:
+            duration = max(0, granule - pre_skip) / granule_rate
+
+    if duration:
+        bitrate = int(file_size * 8 / duration)
+    else:
+        bitrate = max(nominal_bitrate, 0)
+
+    return {
+        'codec': codec,
+        'duration': duration,
+        'bitrate': bitrate,
+        'sample_rate': sample_rate,
+        'channels': channels
+    }
+
+def probe_ffprobe(path):
+    """Ask ffprobe, for anything the header parsers don't understand"""
+    command = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'format=duration,bit_rate:stream=codec_name,sample_rate,channels',
+        '-of', 'json',
+        path
+    ]
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"Error running ffprobe: {str(e)}")
+        return None
+    if process.returncode != 0:
+        logger.error(f"ffprobe failed: {process.stderr.decode(errors='replace')}")
+        return None
+
+    result = json.loads(process.stdout or b'{}')
+    fmt = result.get('format', {})
+    stream = (result.get('streams') or [{}])[0]
+    return {
+        'codec': stream.get('codec_name'),
+        'duration': float(fmt.get('duration') or 0),
+        'bitrate': int(fmt.get('bit_rate') or 0),
+        'sample_rate': int(stream.get('sample_rate') or 0),
+        'channels': int(stream.get('channels') or 0)
+    }
+
+PROBES = {
+    'mp3': probe_mp3,
+    'wav': probe_wav,
+    'ogg': probe_ogg,
+}
+
+def probe_audio(path):
+    """Read duration, bitrate, sample rate and channels from an audio file's headers.
+
+    Only a few KB at the start (and end, for Ogg) of the file are read. Falls back
+    to ffprobe for formats or files the parsers can't handle. Duration is in
+    seconds, bitrate in bits per second.
+    """
+    metadata = None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SCAN_BYTES)
+        probe = PROBES.get(detect_format(head, at_eof=len(head) < SCAN_BYTES))
+        if probe:
+            metadata = probe(path)
+    except Exception as e:
+        logger.error(f"Error parsing audio headers of {path}: {str(e)}")
+
+    if not metadata or not metadata['duration']:
+        logger.debug(f"Header probe inconclusive for {path}, falling back to ffprobe")
+        metadata = probe_ffprobe(path) or metadata
+
+    if metadata:
+        logger.debug(f"Probed {path}: {metadata}")
+    return metadata
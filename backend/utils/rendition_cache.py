@@ -0,0 +1,244 @@
+from collections import OrderedDict
+from flask import current_app
+from utils.metrics import metrics
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB
+STALE_TEMP_SECONDS = 60 * 60
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Source hashes keyed by (path, size, mtime) so we don't re-read unchanged files
+_source_hashes = {}
+_source_hashes_lock = threading.Lock()
+
+def source_hash(path):
+    """SHA-256 of a source file, memoized on its size and modification time"""
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _source_hashes_lock:
+        if memo_key in _source_hashes:
+            return _source_hashes[memo_key]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    with _source_hashes_lock:
+        if len(_source_hashes) > 10000:
+            _source_hashes.clear()
+        _source_hashes[memo_key] = digest.hexdigest()
+    return _source_hashes[memo_key]
+
+def rendition_key(source_sha256, rendition):
+    """Content key for a rendition: source hash + codec + sample rate"""
+    return f"{source_sha256}-{rendition['codec']}-{rendition['sample_rate']}"
+
+class CacheFill:
+    """A rendition being produced; commit() publishes it, abort() throws it away"""
+
+    def __init__(self, cache, key, ext, temp_path):
+        self.cache = cache
+        self.key = key
+        self.ext = ext
+        self.path = temp_path
+        self.done = False
+
+    def commit(self):
+        return self.cache._commit(self)
+
+    def abort(self):
+        self.cache._abort(self)
+
+class RenditionCache:
+    """Size-bounded on-disk LRU cache of transcoded renditions.
+
+    Finished files are published with an atomic rename, so readers never see a
+    partial rendition. Only one fill per key runs at a time in this process;
+    other requests for the same key wait for it.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (filename, size), least recently used first
+        self._total_bytes = 0
+        self._inflight = {}  # key -> threading.Event
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Index renditions already on disk, oldest access first"""
+        found = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith('.tmp'):
+                # Leftovers from a crashed fill
+                if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            key = name.rsplit('.', 1)[0]
+            found.append((stat.st_mtime, key, name, stat.st_size))
+
+        for _, key, name, size in sorted(found):
+            self._entries[key] = (name, size)
+            self._total_bytes += size
+        logger.debug(f"Rendition cache loaded {len(self._entries)} entries ({self._total_bytes} bytes) from {self.root}")
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, key):
+        """Return the path of a cached rendition, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                path = os.path.join(self.root, entry[0])
+                if os.path.exists(path):
+                    self._entries.move_to_end(key)
+                    metrics.incr('rendition_cache.hits')
+                    try:
+                        # Persist recency so LRU order survives restarts
+                        os.utime(path)
+                    except OSError:
+                        pass
+                    return path
+                # Evicted by another process
+                del self._entries[key]
+                self._total_bytes -= entry[1]
+            metrics.incr('rendition_cache.misses')
+            return None
+
+    def begin(self, key, ext):
+        """Claim the fill for key; returns None if another request is already filling it"""
+        with self._lock:
+            if key in self._inflight:
+                return None
+            self._inflight[key] = threading.Event()
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=f".{key}.", suffix='.tmp')
+        os.close(fd)
+        return CacheFill(self, key, ext, temp_path)
+
+    def wait(self, key, timeout=None):
+        """Wait for an in-flight fill of key and return its path (None if it failed)"""
+        with self._lock:
+            event = self._inflight.get(key)
+        if event:
+            metrics.incr('rendition_cache.waits')
+            event.wait(timeout)
+        return self.get(key)
+
+    def fill(self, key, ext, produce, timeout=None):
+        """Return the cached rendition for key, running produce(temp_path) on a miss.
+
+        Raises TimeoutError if another request's fill is still running after timeout.
+        """
+        for _ in range(3):
+            path = self.get(key)
+            if path:
+                return path
+
+            pending = self.begin(key, ext)
+            if pending is None:
+                path = self.wait(key, timeout)
+                if path:
+                    return path
+                with self._lock:
+                    if key in self._inflight:
+                        raise TimeoutError(f"Rendition {key} is still being produced")
+                # The leader failed; try to take over
+                continue
+
+            try:
+                produce(pending.path)
+            except BaseException:
+                pending.abort()
+                raise
+            return pending.commit()
+        raise RuntimeError(f"Could not produce rendition {key}")
+
+    def _commit(self, pending):
+        filename = f"{pending.key}.{pending.ext}"
+        final_path = os.path.join(self.root, filename)
+        try:
+            size = os.path.getsize(pending.path)
+            os.replace(pending.path, final_path)
+        except BaseException:
+            self._abort(pending)
+            raise
+
+        with self._lock:
+            old = self._entries.pop(pending.key, None)
+            if old:
+                self._total_bytes -= old[1]
+            self._entries[pending.key] = (filename, size)
+            self._total_bytes += size
+            self._evict()
+            self._finish(pending)
+        metrics.incr('rendition_cache.fills')
+        logger.debug(f"Published rendition {filename} ({size} bytes)")
+        return final_path
+
+    def _abort(self, pending):
+        try:
+            if os.path.exists(pending.path):
+                os.remove(pending.path)
+        except OSError as e:
+            logger.error(f"Error removing partial rendition {pending.path}: {str(e)}")
+        with self._lock:
+            self._finish(pending)
+
+    def _finish(self, pending):
+        if pending.done:
+            return
+        pending.done = True
+        event = self._inflight.pop(pending.key, None)
+        if event:
+            event.set()
+
+    def _evict(self):
+        # Keep the most recent entry even if it alone exceeds the budget
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, (filename, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.root, filename))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error evicting rendition {filename}: {str(e)}")
+            metrics.incr('rendition_cache.evictions')
+            logger.debug(f"Evicted rendition {filename} ({size} bytes)")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_rendition_cache():
+    """Process-wide rendition cache, configured from the environment"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            root = os.getenv('RENDITION_CACHE_DIR') or os.path.join(current_app.root_path, 'cache', 'renditions')
+            max_mb = os.getenv('RENDITION_CACHE_MAX_MB')
+            max_bytes = int(max_mb) * 1024 * 1024 if max_mb else DEFAULT_MAX_BYTES
+            _cache = RenditionCache(root, max_bytes)
+            metrics.gauge('rendition_cache.bytes', lambda: _cache.total_bytes)
+            metrics.gauge('rendition_cache.entries', lambda: len(_cache._entries))
+        return _cache
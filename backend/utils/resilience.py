@@ -0,0 +1,156 @@
+from utils.metrics import metrics
+import os
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a service that keeps failing; retry_after is a hint in seconds"""
+
+    def __init__(self, message, retry_after=1, recovering=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        # Half-open: a trial call is still deciding, the service hasn't failed again
+        self.recovering = recovering
+
+class TransientError(Exception):
+    """A failure worth retrying (throttling, 5xx, timeouts), with the server's Retry-After if it sent one"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Stops calling a service once transient errors cluster.
+
+    failure_threshold transient errors within window seconds open the
+    circuit for reset_timeout seconds (or the server's Retry-After, if
+    longer). After that one trial call is let through: success closes the
+    circuit, another failure opens it again. A trial that hasn't reported
+    back within trial_timeout seconds (its caller hung or died) is handed
+    to the next caller.
+    """
+
+    def __init__(self, name, failure_threshold=5, window=60, reset_timeout=30, trial_timeout=300):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.trial_timeout = trial_timeout
+        self._lock = threading.Lock()
+        self._failures = []
+        self._open_until = 0.0
+        # Deadline of the trial call in flight, 0 if there is none
+        self._trial_until = 0.0
+
+        metrics.gauge(f'{name}.circuit_open', lambda: int(self.remaining() > 0))
+
+    def remaining(self):
+        """Seconds until the circuit lets calls through again, 0 if it's closed.
+
+        While a trial call is in flight that's the time left until it has to
+        report back, though the circuit may close well before.
+        """
+        now = time.monotonic()
+        return max(0.0, self._open_until - now, self._trial_until - now)
+
+    def before(self):
+        """Call before using the service; raises CircuitOpen while it's open"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._open_until:
+                raise CircuitOpen(f"{self.name} is unavailable", int(self._open_until - now) + 1)
+            if not self._open_until:
+                return
+            if now >= self._trial_until:
+                # Half-open: this caller is the trial, others wait for its outcome
+                if self._trial_until:
+                    logger.warning(f"Circuit {self.name} trial call timed out, starting another")
+                self._trial_until = now + self.trial_timeout
+                return
+            wait = min(self.reset_timeout, self._trial_until - now)
+            raise CircuitOpen(f"{self.name} is recovering", int(wait) + 1, recovering=True)
+
+    def success(self):
+        with self._lock:
+            if self._open_until:
+                logger.info(f"Circuit {self.name} closed")
+            self._failures = []
+            self._open_until = 0.0
+            self._trial_until = 0.0
+
+    def failure(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self._failures = [at for at in self._failures if now - at < self.window]
+            self._failures.append(now)
+            if self._trial_until or len(self._failures) >= self.failure_threshold:
+                pause = max(self.reset_timeout, retry_after or 0)
+                self._open_until = now + pause
+                self._trial_until = 0.0
+                self._failures = []
+                metrics.incr(f'{self.name}.circuit_opened')
+                logger.warning(f"Circuit {self.name} opened for {pause:.0f}s")
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Full-jitter exponential backoff: a random delay up to base * 2^attempt, capped"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def call_with_retry(fn, breaker, classify, attempts=4, base=1.0, cap=30.0, max_wait=60.0):
+    """Call fn, retrying transient failures with jittered exponential backoff.
+
+    classify(exception) returns a TransientError for failures worth retrying
+    and None for the rest, which are raised straight away. A Retry-After from
+    the server is honoured instead of our own delay. Transient failures are
+    reported to breaker; once it opens, or the server asks for a wait longer
+    than max_wait, CircuitOpen is raised so the caller can put the work aside.
+    If the retries run out while the breaker is still closed, the problem is
+    this call's, not the service's: the TransientError is raised.
+    """
+    for attempt in range(attempts):
+        breaker.before()
+        try:
+            result = fn()
+        except Exception as e:
+            transient = classify(e)
+            if transient is None:
+                # The service answered, it just didn't like this request
+                breaker.success()
+                raise
+            breaker.failure(transient.retry_after)
+            metrics.incr(f'{breaker.name}.retries')
+            if attempt == attempts - 1:
+                if breaker.remaining() > 0:
+                    raise CircuitOpen(f"{breaker.name} keeps failing: {transient}", int(breaker.remaining()) + 1)
+                raise transient from e
+            delay = transient.retry_after if transient.retry_after is not None else backoff_delay(attempt, base, cap)
+            if delay > max_wait:
+                raise CircuitOpen(f"{breaker.name} asked us to wait {delay:.0f}s", int(delay) + 1)
+            logger.warning(f"{breaker.name} call failed ({transient}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        breaker.success()
+        return result
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header given in seconds; None if absent or a date"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+spotify_breaker = CircuitBreaker(
+    'spotify',
+    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+    reset_timeout=float(os.getenv('CIRCUIT_RESET_SECONDS', '30')),
+    trial_timeout=float(os.getenv('CIRCUIT_TRIAL_SECONDS', '300'))
+)
+youtube_breaker = CircuitBreaker(
+    'youtube',
+    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+    reset_timeout=float(os.getenv('CIRCUIT_RESET_SECONDS', '30')),
+    trial_timeout=float(os.getenv('CIRCUIT_TRIAL_SECONDS', '300'))
+)
@@ -0,0 +1,196 @@
+from collections import OrderedDict, deque
+from utils.metrics import metrics
+import math
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    """Raised when no slot can be handed out; retry_after is a hint in seconds"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Slot:
+    """A granted slot; release() is idempotent so it can be wired to several cleanup paths"""
+
+    def __init__(self, scheduler, user_id, priority=None):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.priority = priority
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class _Ticket:
+    def __init__(self, user_id, priority):
+        self.user_id = user_id
+        self.priority = priority
+        self.granted = False
+        self.enqueued = time.monotonic()
+
+class FairScheduler:
+    """Fixed number of slots shared round-robin between users, with a bounded queue.
+
+    Each user gets their own FIFO; whenever a slot frees up the next user in
+    turn is served, so one user queueing many jobs can't starve the others.
+
+    Optionally, per_user caps how many slots one user holds at once, and
+    weights defines priority classes ({'interactive': 4, 'bulk': 1}): when
+    several classes are waiting, each gets slots in proportion to its weight
+    (stride scheduling), so a low class is slowed down but never starved.
+    """
+
+    def __init__(self, name, slots, max_queue, queue_timeout, per_user=None, weights=None):
+        self.name = name
+        self.slots = slots
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.per_user = per_user
+        self.weights = weights or {'default': 1}
+        self.default_priority = next(iter(self.weights))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._user_active = {}
+        # priority -> OrderedDict of user_id -> deque of tickets, in serving order
+        self._queues = {priority: OrderedDict() for priority in self.weights}
+        self._queued_by_priority = {priority: 0 for priority in self.weights}
+        # Stride scheduling: the waiting class with the lowest pass is served next
+        self._pass = {priority: 0.0 for priority in self.weights}
+        self._avg_hold = 1.0
+
+        metrics.gauge(f'{name}.active', lambda: self._active)
+        metrics.gauge(f'{name}.queue_depth', lambda: self._queued)
+        metrics.gauge(f'{name}.slots', lambda: self.slots)
+        if len(self.weights) > 1:
+            for priority in self.weights:
+                metrics.gauge(f'{name}.queue_depth.{priority}', lambda priority=priority: self._queued_by_priority[priority])
+
+    def retry_after(self):
+        """Rough estimate of how long until a queue position opens up"""
+        waves = (self._queued // max(self.slots, 1)) + 1
+        return max(1, int(math.ceil(waves * self._avg_hold)))
+
+    def _user_has_room(self, user_id):
+        return self.per_user is None or self._user_active.get(user_id, 0) < self.per_user
+
+    def _grant(self, user_id):
+        self._active += 1
+        self._user_active[user_id] = self._user_active.get(user_id, 0) + 1
+
+    def acquire(self, user_id, timeout=None, priority=None):
+        timeout = self.queue_timeout if timeout is None else timeout
+        priority = priority or self.default_priority
+        if priority not in self.weights:
+            raise ValueError(f"Unknown {self.name} priority: {priority}")
+        with self._cond:
+            if self._active < self.slots and self._queued == 0 and self._user_has_room(user_id):
+                self._grant(user_id)
+                metrics.observe(f'{self.name}.wait', 0.0)
+                return Slot(self, user_id, priority)
+
+            if self._queued >= self.max_queue:
+                metrics.incr(f'{self.name}.rejected')
+                logger.warning(f"{self.name} queue full ({self._queued} waiting), rejecting {user_id}")
+                raise QueueFull(f"{self.name} queue is full", self.retry_after())
+
+            ticket = _Ticket(user_id, priority)
+            if not self._queued_by_priority[priority]:
+                # A class coming back from idle doesn't get credit for the time it was away
+                self._pass[priority] = max(self._pass[priority], self._min_waiting_pass())
+            self._queues[priority].setdefault(user_id, deque()).append(ticket)
+            self._queued += 1
+            self._queued_by_priority[priority] += 1
+            # Slots may be free with only capped users waiting
+            self._dispatch()
+            deadline = ticket.enqueued + timeout
+
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._cancel(ticket)
+                    metrics.incr(f'{self.name}.timeouts')
+                    raise QueueFull(f"Timed out waiting for a {self.name} slot", self.retry_after())
+                self._cond.wait(remaining)
+
+        waited = time.monotonic() - ticket.enqueued
+        metrics.observe(f'{self.name}.wait', waited)
+        if len(self.weights) > 1:
+            metrics.observe(f'{self.name}.wait.{priority}', waited)
+        logger.debug(f"{self.name} slot granted to {user_id} ({priority}) after {waited:.3f}s")
+        return Slot(self, user_id, priority)
+
+    def _min_waiting_pass(self):
+        waiting = [self._pass[priority] for priority, count in self._queued_by_priority.items() if count]
+        return min(waiting) if waiting else max(self._pass.values())
+
+    def _cancel(self, ticket):
+        queues = self._queues[ticket.priority]
+        queue = queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self._queued -= 1
+            self._queued_by_priority[ticket.priority] -= 1
+            if not queue:
+                del queues[ticket.user_id]
+
+    def _release(self, slot):
+        held = time.monotonic() - slot.started
+        metrics.observe(f'{self.name}.hold', held)
+        with self._cond:
+            self._avg_hold = 0.8 * self._avg_hold + 0.2 * held
+            self._active -= 1
+            self._user_active[slot.user_id] -= 1
+            if not self._user_active[slot.user_id]:
+                del self._user_active[slot.user_id]
+            self._dispatch()
+
+    def _next_ticket(self, priority):
+        """Pop the next ticket of a class from the first user in turn with room, or None"""
+        queues = self._queues[priority]
+        for user_id, queue in queues.items():
+            if not self._user_has_room(user_id):
+                continue
+            ticket = queue.popleft()
+            if queue:
+                # Back of the line for this user's next job
+                queues.move_to_end(user_id)
+            else:
+                del queues[user_id]
+            return ticket
+        return None
+
+    def _dispatch(self):
+        granted = False
+        while self._active < self.slots and self._queued:
+            ticket = None
+            for priority in sorted(self._queues, key=lambda priority: self._pass[priority]):
+                if self._queued_by_priority[priority]:
+                    ticket = self._next_ticket(priority)
+                    if ticket:
+                        break
+            if ticket is None:
+                # Everyone waiting is at their per-user cap
+                break
+            self._pass[ticket.priority] += 1.0 / self.weights[ticket.priority]
+            ticket.granted = True
+            self._grant(ticket.user_id)
+            self._queued -= 1
+            self._queued_by_priority[ticket.priority] -= 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
@@ -0,0 +1,56 @@
+from flask import current_app
+from urllib.parse import urlencode
+import base64
+import hashlib
+import hmac
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Signed stream URLs are valid for between one and two of these. Expiry is
+# rounded to a multiple of it, so minting again soon after gives the same URL
+# and the browser's cache of it stays useful
+STREAM_URL_TTL = int(os.getenv('STREAM_URL_TTL_SECONDS', '3600'))
+
+def _stream_key():
+    # Derived from SECRET_KEY so a stream signature can't be passed off as anything else
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'), b'stream-url', hashlib.sha256).digest()
+
+def _signature(song_id, user_id, expires, file_path):
+    message = f"{song_id}\n{user_id}\n{expires}\n{file_path}".encode('utf-8')
+    digest = hmac.new(_stream_key(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+def sign_stream_url(song_id, user_id, file_path, ttl=STREAM_URL_TTL):
+    """Path and expiry (unix time) of a URL that streams one song without a token.
+
+    The stored file path is part of the signed payload, so the stream
+    endpoint can serve the original file without looking the song up.
+    """
+    expires = (int(time.time()) // ttl + 2) * ttl
+    params = {
+        'uid': str(user_id),
+        'exp': expires,
+        'file': file_path,
+        'sig': _signature(song_id, user_id, expires, file_path)
+    }
+    return f"/api/songs/stream/{song_id}?{urlencode(params)}", expires
+
+def verify_stream_url(song_id, args):
+    """The grant ({'user_id', 'file_path', 'expires'}) of a signed stream URL's query args, or None"""
+    try:
+        user_id = args['uid']
+        file_path = args['file']
+        expires = int(args['exp'])
+        signature = args['sig']
+    except (KeyError, ValueError):
+        return None
+    if expires < time.time():
+        logger.debug(f"Stream URL for song {song_id} expired at {expires}")
+        return None
+    if not hmac.compare_digest(signature, _signature(song_id, user_id, expires, file_path)):
+        logger.error(f"Bad stream URL signature for song {song_id}")
+        return None
+    return {'user_id': user_id, 'file_path': file_path, 'expires': expires}
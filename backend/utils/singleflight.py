@@ -0,0 +1,157 @@
+from database import db
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from utils.metrics import metrics
+import os
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Lease held by the process doing the work, extended while it runs
+DOWNLOAD_LEASE_SECONDS = int(os.getenv('DOWNLOAD_LEASE_SECONDS', '120'))
+# How long a follower waits for someone else's download
+DOWNLOAD_WAIT_TIMEOUT = int(os.getenv('DOWNLOAD_WAIT_TIMEOUT', '600'))
+# How long a finished result is offered to late followers
+DOWNLOAD_RESULT_TTL = timedelta(hours=1)
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.shared = None
+        self.error = None
+
+class SingleFlight:
+    """Runs work for a key once at a time, across threads and processes.
+
+    Within a process, concurrent callers for the same key wait on the first
+    one. Across processes, a lease document in Mongo elects the leader; the
+    others poll it until the leader publishes its result.
+
+    lead() does the work and returns (value, shared), where shared is a small
+    JSON-able result published to followers. follow(shared) turns that into
+    a follower's own value, or returns None if it can't be used anymore. If
+    the leader fails or its result can't be used, followers in this and
+    other processes alike compete for the lease again, and one of them does
+    the work.
+    """
+
+    def __init__(self, collection, lease_seconds=DOWNLOAD_LEASE_SECONDS, poll_interval=1.0):
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def run(self, key, lead, follow, timeout=DOWNLOAD_WAIT_TIMEOUT):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            metrics.incr('singleflight.local_waits')
+            started = time.monotonic()
+            if not flight.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for {key}")
+            if flight.error is None:
+                value = follow(flight.shared)
+                if value is not None:
+                    return value
+            # The leader failed, or its result was gone by the time we got to
+            # it: start over, through the lease like a follower in another
+            # process, so only one of us takes over
+            return self.run(key, lead, follow, max(0, timeout - (time.monotonic() - started)))
+
+        try:
+            value, flight.shared = self._run_shared(key, lead, follow, timeout)
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _run_shared(self, key, lead, follow, timeout):
+        """Lead or follow across processes through the lease document"""
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while True:
+            doc = self.collection.find_one({'_id': key})
+            if doc and doc['status'] == 'done':
+                value = follow(doc['shared'])
+                if value is not None:
+                    metrics.incr('singleflight.shared_hits')
+                    return value, doc['shared']
+            if self._claim(key, owner, doc):
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for {key}")
+            metrics.incr('singleflight.shared_waits')
+            time.sleep(self.poll_interval)
+
+        logger.debug(f"Leading {key}")
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_seconds / 3):
+                self.collection.update_one(
+                    {'_id': key, 'owner': owner},
+                    {'$set': {'lease_until': datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+                )
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            value, shared = lead()
+        except Exception as e:
+            self._finish(key, owner, 'failed', error=str(e))
+            raise
+        finally:
+            stop.set()
+            beat.join()
+        self._finish(key, owner, 'done', shared=shared)
+        return value, shared
+
+    def _claim(self, key, owner, doc):
+        """Take the lease if nobody holds a live one"""
+        now = datetime.utcnow()
+        lease = {
+            'status': 'running',
+            'owner': owner,
+            'lease_until': now + timedelta(seconds=self.lease_seconds),
+            'shared': None,
+            'error': None,
+            # Leftovers of crashed processes go away on their own
+            'expires_at': now + timedelta(days=1)
+        }
+        if doc is None:
+            try:
+                self.collection.insert_one({'_id': key, **lease})
+                return True
+            except DuplicateKeyError:
+                return False
+        return self.collection.update_one(
+            {'_id': key, '$or': [{'status': {'$ne': 'running'}}, {'lease_until': {'$lt': now}}]},
+            {'$set': lease}
+        ).matched_count == 1
+
+    def _finish(self, key, owner, status, shared=None, error=None):
+        now = datetime.utcnow()
+        self.collection.update_one(
+            {'_id': key, 'owner': owner},
+            {'$set': {
+                'status': status,
+                'shared': shared,
+                'error': error,
+                'lease_until': None,
+                'expires_at': now + (DOWNLOAD_RESULT_TTL if status == 'done' else timedelta(0))
+            }}
+        )
+
+download_flights = SingleFlight(db.download_leases)
@@ -0,0 +1,165 @@
+from database import db
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from utils.metrics import metrics
+from utils.scheduler import QueueFull
+import os
+import random
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Lease on a slot, extended while it's held; a crashed process's slots free up after this
+SLOT_LEASE_SECONDS = int(os.getenv('DOWNLOAD_LEASE_SECONDS', '120'))
+
+class SharedSlot:
+    """A slot held in a SharedSlots pool; release() is idempotent"""
+
+    def __init__(self, pool, keys, owner):
+        self.pool = pool
+        self.keys = keys
+        self.owner = owner
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class SharedSlots:
+    """A fixed number of slots shared by every process, with an optional per-user cap.
+
+    Each slot is a lease document in Mongo: '<name>:<i>' for the pool and
+    '<name>:<user>:<j>' for a user's share. A slot is taken by an upsert
+    that only matches a free or expired lease, so two processes can't both
+    get it. Held leases are heartbeated. Callers that find no free slot poll
+    until one frees up; ordering between them is up to the caller (e.g. a
+    FairScheduler per process in front of this).
+    """
+
+    def __init__(self, collection, name, slots, per_user=None, lease_seconds=SLOT_LEASE_SECONDS, poll_interval=1.0):
+        self.collection = collection
+        self.name = name
+        self.slots = slots
+        self.per_user = per_user
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._held = set()
+        self._beat = None
+
+        metrics.gauge(f'{name}.shared_held', lambda: len(self._held))
+
+    def acquire(self, user_id, timeout):
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+        while True:
+            keys = self._try_acquire(user_id, owner)
+            if keys:
+                break
+            if time.monotonic() >= deadline:
+                metrics.incr(f'{self.name}.shared_timeouts')
+                raise QueueFull(f"Timed out waiting for a shared {self.name} slot", int(self.poll_interval) + 1)
+            metrics.incr(f'{self.name}.shared_waits')
+            # Jitter so processes polling for the same slot don't keep colliding
+            time.sleep(self.poll_interval * random.uniform(0.5, 1.5))
+
+        metrics.observe(f'{self.name}.shared_wait', time.monotonic() - started)
+        with self._lock:
+            self._held.add(owner)
+            if self._beat is None:
+                self._beat = threading.Thread(target=self._heartbeat, daemon=True)
+                self._beat.start()
+        return SharedSlot(self, keys, owner)
+
+    def _try_acquire(self, user_id, owner):
+        """Take a user slot and then a pool slot; returns their keys, or None with nothing held"""
+        keys = []
+        if self.per_user:
+            user_key = self._take_any([f"{self.name}:{user_id}:{j}" for j in range(self.per_user)], owner, user_id)
+            if not user_key:
+                return None
+            keys.append(user_key)
+        pool_keys = [f"{self.name}:{i}" for i in range(self.slots)]
+        random.shuffle(pool_keys)
+        pool_key = self._take_any(pool_keys, owner, user_id)
+        if not pool_key:
+            self._give_back(keys, owner)
+            return None
+        return keys + [pool_key]
+
+    def _take_any(self, keys, owner, user_id):
+        for key in keys:
+            if self._take(key, owner, user_id):
+                return key
+        return None
+
+    def _take(self, key, owner, user_id):
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=self.lease_seconds)
+        try:
+            self.collection.update_one(
+                {'_id': key, '$or': [{'owner': None}, {'lease_until': {'$lt': now}}]},
+                {'$set': {
+                    'owner': owner,
+                    'user_id': str(user_id),
+                    'lease_until': lease_until,
+                    # Per-user slot documents of users who stopped importing go away on their own
+                    'expires_at': lease_until + timedelta(days=1)
+                }},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Someone else holds a live lease on it
+            return False
+
+    def _give_back(self, keys, owner):
+        if keys:
+            self.collection.update_many(
+                {'_id': {'$in': keys}, 'owner': owner},
+                {'$set': {'owner': None, 'lease_until': None}}
+            )
+
+    def _release(self, slot):
+        with self._lock:
+            self._held.discard(slot.owner)
+        try:
+            self._give_back(slot.keys, slot.owner)
+        except Exception as e:
+            # The lease runs out on its own
+            logger.error(f"Error releasing shared {self.name} slot: {str(e)}")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                owners = list(self._held)
+            if not owners:
+                continue
+            try:
+                lease_until = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+                self.collection.update_many(
+                    {'owner': {'$in': owners}},
+                    {'$set': {'lease_until': lease_until, 'expires_at': lease_until + timedelta(days=1)}}
+                )
+            except Exception as e:
+                logger.error(f"Error extending shared {self.name} slots: {str(e)}")
+
+# Caps on YouTube downloads across every worker process
+download_slots = SharedSlots(
+    db.download_slots,
+    'downloads',
+    slots=int(os.getenv('DOWNLOAD_SLOTS', '4')),
+    per_user=int(os.getenv('DOWNLOAD_SLOTS_PER_USER', '2'))
+)
@@ -1,29 +1,230 @@
 import spotipy
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials
+import requests
+from requests.adapters import HTTPAdapter
 import yt_dlp
+from utils.spotify_cache import TrackBatcher
+from utils.resilience import CircuitOpen, TransientError, call_with_retry, retry_after_seconds, spotify_breaker, youtube_breaker
+from contextlib import contextmanager
+import json
 import os
+import queue
 import re
+import shutil
+import tempfile
+import threading
+import zlib
 import logging
 
 logger = logging.getLogger(__name__)
 
+# open.spotify.com links, optionally with a locale segment (/intl-de/track/...)
+SPOTIFY_URL = re.compile(r'^https://open\.spotify\.com/(?:intl-[a-z]{2}(?:-[a-z]{2})?/)?(track|album|playlist)/([A-Za-z0-9]{22})(?![A-Za-z0-9])')
+# Spotify ids are 22 base62 characters; one bad id makes Spotify reject a whole batch
+SPOTIFY_ID = re.compile(r'^[A-Za-z0-9]{22}$')
+# Tracks per Spotify API page when expanding albums and playlists
+PAGE_SIZE = 50
+
+# Client-credentials token shared by every process through this file
+SPOTIFY_TOKEN_CACHE = os.getenv('SPOTIFY_TOKEN_CACHE', os.path.join(tempfile.gettempdir(), 'vince-spotify-token'))
+
+# 'native' stores the downloaded audio stream as-is, 'mp3' re-encodes it to 192k MP3
+INGEST_MODE = os.getenv('INGEST_MODE', 'native').lower()
+
+# yt-dlp errors that mean "slow down" or "try again later" rather than "no such video"
+YOUTUBE_TRANSIENT = re.compile(r'HTTP Error (429|5\d\d)|Too Many Requests|timed out|Connection reset|not a bot|Temporary failure', re.IGNORECASE)
+
+def spotify_transient(e):
+    """TransientError for Spotify throttling, server errors and network trouble; None otherwise"""
+    if isinstance(e, SpotifyException) and (e.http_status == 429 or (e.http_status or 0) >= 500):
+        return TransientError(str(e), retry_after_seconds((e.headers or {}).get('Retry-After')))
+    if isinstance(e, requests.exceptions.RequestException):
+        return TransientError(str(e))
+    return None
+
+def youtube_transient(e):
+    """TransientError for YouTube throttling and network trouble; None otherwise"""
+    if isinstance(e, yt_dlp.utils.DownloadError) and YOUTUBE_TRANSIENT.search(str(e)):
+        return TransientError(str(e))
+    return None
+
+class SharedTokenCache(CacheHandler):
+    """The client-credentials token, in a file shared by every process.
+
+    spotipy's CacheFileHandler rewrites the file in place, so a process
+    reading while another refreshes could get half a token and fail. Here
+    the token goes to a private (0600) temp file that is renamed over the
+    cache, and a cache that can't be read or parsed counts as empty.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_cached_token(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable Spotify token cache {self.path}: {str(e)}")
+            return None
+
+    def save_token_to_cache(self, token_info):
+        try:
+            # mkstemp creates the file readable by us only
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.spotify-token-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(token_info, f)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        except OSError as e:
+            # Only costs another token request next time
+            logger.warning(f"Couldn't save Spotify token cache {self.path}: {str(e)}")
+
+def parse_spotify_url(url):
+    """(kind, id) for a Spotify track, album or playlist URL, or None"""
+    match = SPOTIFY_URL.match(url or '')
+    if not match:
+        return None
+    return match.group(1), match.group(2)
+
+class YoutubeDLPool:
+    """Long-lived YoutubeDL instances with the same options.
+
+    A YoutubeDL instance isn't safe to share between threads, so each one is
+    lent to a single thread at a time; at most size instances are created.
+    """
+
+    def __init__(self, params, size):
+        self.params = params
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def borrow(self):
+        try:
+            ydl = self._idle.get_nowait()
+        except queue.Empty:
+            ydl = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    ydl = yt_dlp.YoutubeDL(self.params)
+            if ydl is None:
+                ydl = self._idle.get()
+        try:
+            yield ydl
+        finally:
+            self._idle.put(ydl)
+
 class SpotifyDownloader:
-    def __init__(self, client_id, client_secret):
+    """Spotify metadata and YouTube downloads, meant to be created once per process.
+
+    Holds a keep-alive HTTP session and a client-credentials token that's
+    cached in SPOTIFY_TOKEN_CACHE (refreshed shortly before it expires, and
+    reused by the other processes), plus pools of YoutubeDL instances.
+    Downloads land in a per-process staging dir as <video id>.<ext> and are
+    moved to the caller's output dir.
+    """
+
+    def __init__(self, client_id, client_secret, cache=None, matches=None, staging_dir=None, pool_size=4):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 4) * 2)
+        self.session.mount('https://', adapter)
         self.spotify = spotipy.Spotify(
             client_credentials_manager=SpotifyClientCredentials(
                 client_id=client_id,
-                client_secret=client_secret
-            )
+                client_secret=client_secret,
+                cache_handler=SharedTokenCache(SPOTIFY_TOKEN_CACHE),
+                requests_session=self.session
+            ),
+            requests_session=self.session,
+            # Retries (and waiting out 429s) are ours to do, see call_spotify
+            retries=0,
+            status_retries=0,
+            requests_timeout=10
         )
+
+        if staging_dir:
+            # Anything left here is from an earlier process
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            os.makedirs(staging_dir, exist_ok=True)
+        self.staging_dir = staging_dir or tempfile.mkdtemp(prefix='ydl-staging-')
+
+        if INGEST_MODE == 'native':
+            # Keep whatever codec YouTube serves, preferably Opus: 'best' makes
+            # ffmpeg copy the stream into a plain audio container (Opus into
+            # Ogg, AAC into m4a) instead of re-encoding a fallback format
+            format_opts = {
+                'format': 'bestaudio[acodec=opus]/bestaudio',
+                'postprocessors': [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'best',
+                }],
+            }
+        else:
+            format_opts = {
+                'format': 'bestaudio/best',
+                'postprocessors': [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'mp3',
+                    'preferredquality': '192',
+                }],
+            }
         self.ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
+            **format_opts,
             'quiet': True,
             'no_warnings': True,
+            # Keep yt-dlp's own retrying short, call_youtube backs off properly
+            'retries': 2,
+            'extractor_retries': 1,
+            'outtmpl': os.path.join(self.staging_dir, '%(id)s.%(ext)s'),
+        }
+        # Pooled instances are shared, so their hooks report to whichever
+        # thread is using them through a thread-local callback
+        self._local = threading.local()
+        self.ydl_opts['progress_hooks'] = [self._download_hook]
+        self.ydl_opts['postprocessor_hooks'] = [self._postprocess_hook]
+        self.search_pool = YoutubeDLPool({'quiet': True, 'no_warnings': True}, pool_size)
+        self.download_pool = YoutubeDLPool(self.ydl_opts, pool_size)
+        # Staged files are named after the video, so one download per video at a time
+        self._video_locks = [threading.Lock() for _ in range(64)]
+        # Track metadata cache (TrackCache) and a batcher merging concurrent lookups
+        self.cache = cache
+        # YouTube match cache (MatchCache), skips the search for tracks we've matched before
+        self.matches = matches
+        self.batcher = TrackBatcher(self.fetch_tracks, max_batch=PAGE_SIZE)
+
+    def call_spotify(self, fn, *args, **kwargs):
+        """Call the Spotify API with backoff, Retry-After and the shared circuit breaker"""
+        return call_with_retry(lambda: fn(*args, **kwargs), spotify_breaker, spotify_transient)
+
+    def call_youtube(self, pool, url, download):
+        """Run a yt-dlp extraction with backoff and the shared circuit breaker"""
+        def extract():
+            with pool.borrow() as ydl:
+                return ydl.extract_info(url, download=download)
+        return call_with_retry(extract, youtube_breaker, youtube_transient)
+
+    def track_info(self, track, album=None):
+        """Our metadata for a Spotify track object (album tracks come without their album)"""
+        album = album or track['album']
+        return {
+            'spotify_id': track['id'],
+            'title': track['name'],
+            'artist': track['artists'][0]['name'],
+            'album': album['name'],
+            'duration': int(track['duration_ms'] / 1000),  # Convert to seconds
+            'cover_art': album['images'][0]['url'] if album['images'] else None
         }
 
     def get_track_info(self, spotify_url):
@@ -32,44 +233,187 @@ class SpotifyDownloader:
         logger.debug(f"Extracted track ID: {track_id}")
         
         # Get track information
-        track = self.spotify.track(track_id)
-        logger.debug(f"Got track info from Spotify: {track['name']} by {track['artists'][0]['name']}")
+        track_info = self.lookup_track(track_id)
+        logger.debug(f"Got track info: {track_info['title']} by {track_info['artist']}")
         
-        return {
-            'title': track['name'],
-            'artist': track['artists'][0]['name'],
-            'album': track['album']['name'],
-            'duration': int(track['duration_ms'] / 1000),  # Convert to seconds
-            'cover_art': track['album']['images'][0]['url'] if track['album']['images'] else None
-        }
+        return track_info
+
+    def _request_tracks(self, track_ids):
+        """One Spotify request for up to PAGE_SIZE ids; id -> info, None if unknown"""
+        response = self.call_spotify(self.spotify.tracks, track_ids)
+        return {track_id: self.track_info(track) if track else None for track_id, track in zip(track_ids, response['tracks'])}
+
+    def fetch_tracks(self, track_ids):
+        """Look tracks up on Spotify, PAGE_SIZE ids per request; id -> info, None if unknown"""
+        infos = {}
+        for start in range(0, len(track_ids), PAGE_SIZE):
+            chunk = track_ids[start:start + PAGE_SIZE]
+            try:
+                infos.update(self._request_tracks(chunk))
+            except SpotifyException as e:
+                if e.http_status != 400 or len(chunk) == 1:
+                    raise
+                # Something in the batch is malformed: look them up one by one so only it fails
+                logger.warning(f"Spotify rejected a batch of {len(chunk)} tracks, retrying one at a time")
+                for track_id in chunk:
+                    try:
+                        infos.update(self._request_tracks([track_id]))
+                    except SpotifyException as single:
+                        if single.http_status != 400:
+                            raise
+                        infos[track_id] = None
+        logger.debug(f"Fetched {len(track_ids)} tracks from Spotify")
+        # One cache write for everything, however the requests were split
+        if self.cache:
+            self.cache.put_many(infos)
+        return infos
+
+    def get_tracks(self, track_ids):
+        """Track info for many ids: cached ones first, the rest in batched requests"""
+        infos = self.cache.get_many(track_ids) if self.cache else {}
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in infos]
+        if missing:
+            infos.update(self.fetch_tracks(missing))
+        return infos
+
+    def lookup_track(self, track_id):
+        """Track info for one id, from the cache or a batched Spotify request"""
+        if not SPOTIFY_ID.match(track_id or ''):
+            raise Exception(f"Invalid Spotify track id: {track_id}")
+        cached = self.cache.get_many([track_id]) if self.cache else {}
+        if track_id in cached:
+            track_info = cached[track_id]
+        else:
+            track_info = self.batcher.get(track_id)
+        if track_info is None:
+            raise Exception(f"Track {track_id} not found on Spotify")
+        return track_info
+
+    def get_playlist_tracks(self, playlist_id):
+        """All tracks of a playlist, PAGE_SIZE per request; local files and episodes are skipped"""
+        tracks = []
+        page = self.call_spotify(
+            self.spotify.playlist_items,
+            playlist_id,
+            limit=PAGE_SIZE,
+            additional_types=('track',),
+            fields='next,items(track(id,type,is_local,name,duration_ms,artists(name),album(name,images)))'
+        )
+        while page:
+            for item in page['items']:
+                track = item.get('track')
+                if not track or track.get('is_local') or track.get('type') != 'track' or not track.get('id'):
+                    continue
+                tracks.append(self.track_info(track))
+            page = self.call_spotify(self.spotify.next, page) if page.get('next') else None
+        logger.debug(f"Playlist {playlist_id} has {len(tracks)} tracks")
+        self.remember(tracks)
+        return tracks
+
+    def get_album_tracks(self, album_id):
+        """All tracks of an album; the album response carries the first page"""
+        album = self.call_spotify(self.spotify.album, album_id)
+        tracks = []
+        page = album['tracks']
+        while page:
+            tracks.extend(self.track_info(track, album) for track in page['items'] if track.get('id'))
+            page = self.call_spotify(self.spotify.next, page) if page.get('next') else None
+        logger.debug(f"Album {album_id} has {len(tracks)} tracks")
+        self.remember(tracks)
+        return tracks
+
+    def remember(self, tracks):
+        """Cache metadata we got for free while listing an album or playlist"""
+        if self.cache and tracks:
+            self.cache.put_many({track['spotify_id']: track for track in tracks})
+
+    def get_collection_tracks(self, spotify_url):
+        """Track metadata for every track behind an album or playlist URL"""
+        kind, collection_id = parse_spotify_url(spotify_url)
+        if kind == 'playlist':
+            return self.get_playlist_tracks(collection_id)
+        if kind == 'album':
+            return self.get_album_tracks(collection_id)
+        raise ValueError(f"Not an album or playlist URL: {spotify_url}")
+
+    def search_youtube(self, title, artist, spotify_id=None, duration=None):
+        keys = self.matches.keys(spotify_id, title, artist, duration) if self.matches else []
+        if keys:
+            match = self.matches.get(keys)
+            if match:
+                logger.debug(f"Using cached YouTube match ({match['source']}): {match['url']}")
+                return match['url']
 
-    def search_youtube(self, title, artist):
         query = f"ytsearch:{title} {artist} official audio"
         logger.debug(f"Searching YouTube with query: {query}")
         
-        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-            try:
-                result = ydl.extract_info(query, download=False)
-                if 'entries' in result and result['entries']:
-                    url = result['entries'][0]['webpage_url']
-                    logger.debug(f"Found YouTube URL: {url}")
-                    return url
-                else:
-                    logger.error("No results found on YouTube")
-            except Exception as e:
-                logger.error(f"Error searching YouTube: {str(e)}")
-                return None
+        try:
+            result = self.call_youtube(self.search_pool, query, download=False)
+            if 'entries' in result and result['entries']:
+                entry = result['entries'][0]
+                url = entry['webpage_url']
+                logger.debug(f"Found YouTube URL: {url}")
+                if keys:
+                    self.matches.put(keys, entry.get('id'), url)
+                return url
+            else:
+                logger.error("No results found on YouTube")
+        except CircuitOpen:
+            # Throttled: not the same as "not found", let the job wait and retry
+            raise
+        except Exception as e:
+            logger.error(f"Error searching YouTube: {str(e)}")
+            return None
         return None
 
     def download_track(self, spotify_url, output_dir):
+        # Get track info from Spotify
+        logger.debug(f"Getting track info for URL: {spotify_url}")
         try:
-            # Get track info from Spotify
-            logger.debug(f"Getting track info for URL: {spotify_url}")
             track_info = self.get_track_info(spotify_url)
-            
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to download track: {str(e)}")
+            raise Exception(f"Failed to download track: {str(e)}")
+        return self.download(track_info, output_dir)
+
+    def _report(self, stage, **data):
+        on_progress = getattr(self._local, 'on_progress', None)
+        if on_progress:
+            on_progress(stage, **data)
+
+    def _download_hook(self, status):
+        if status['status'] == 'downloading':
+            self._report(
+                'download',
+                downloaded_bytes=status.get('downloaded_bytes'),
+                total_bytes=status.get('total_bytes') or status.get('total_bytes_estimate'),
+                speed=status.get('speed'),
+                eta=status.get('eta')
+            )
+
+    def _postprocess_hook(self, status):
+        if status['status'] == 'started':
+            self._report('postprocess', postprocessor=status.get('postprocessor'))
+
+    def download(self, track_info, output_dir, on_progress=None):
+        """Find a track we already have metadata for on YouTube and download it.
+
+        on_progress(stage, **data) is called with the search, download and
+        postprocess stages, and repeatedly with byte counts while downloading.
+        """
+        self._local.on_progress = on_progress
+        try:
+            self._report('search')
             # Search for the track on YouTube
             logger.debug(f"Searching for track on YouTube: {track_info['title']} by {track_info['artist']}")
-            youtube_url = self.search_youtube(track_info['title'], track_info['artist'])
+            youtube_url = self.search_youtube(
+                track_info['title'],
+                track_info['artist'],
+                spotify_id=track_info.get('spotify_id'),
+                duration=track_info.get('duration')
+            )
             
             if not youtube_url:
                 raise Exception("Could not find track on YouTube")
@@ -79,22 +423,15 @@ class SpotifyDownloader:
             safe_filename = re.sub(r'[\s-]+', '_', safe_filename)
             logger.debug(f"Created safe filename: {safe_filename}")
             
-            # Set output template
-            output_template = os.path.join(output_dir, f"{safe_filename}.%(ext)s")
-            logger.debug(f"Output template: {output_template}")
-            
-            ydl_opts = {
-                **self.ydl_opts,
-                'outtmpl': output_template
-            }
-
-            # Download and convert the track
+            # Download and convert the track into the staging dir, then move it out
             logger.debug(f"Downloading from YouTube URL: {youtube_url}")
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([youtube_url])
-
-            # Get the output filename
-            output_filename = f"{safe_filename}.mp3"
+            self._report('download', youtube_url=youtube_url)
+            with self._video_locks[zlib.crc32(youtube_url.encode('utf-8')) % len(self._video_locks)]:
+                info = self.call_youtube(self.download_pool, youtube_url, download=True)
+                staged_path = info['requested_downloads'][0]['filepath']
+                ext = os.path.splitext(staged_path)[1]
+                output_filename = f"{safe_filename}{ext}"
+                shutil.move(staged_path, os.path.join(output_dir, output_filename))
             logger.debug(f"Final output filename: {output_filename}")
             
             return {
@@ -102,10 +439,14 @@ class SpotifyDownloader:
                 'file_path': output_filename
             }
 
+        except CircuitOpen:
+            raise
         except Exception as e:
             logger.error(f"Failed to download track: {str(e)}")
             raise Exception(f"Failed to download track: {str(e)}")
+        finally:
+            self._local.on_progress = None
 
 # Example usage:
-# downloader = SpotifyDownloader(client_id='your_client_id', client_secret='your_client_secret')
+# downloader = SpotifyDownloader(client_id='your_client_id', client_secret='your_client_secret', staging_dir='staging')
 # track_info = downloader.download_track('spotify_track_url', 'output_directory') 
\ No newline at end of file
@@ -0,0 +1,195 @@
+from database import db
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from utils.metrics import metrics
+import os
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How long track metadata is trusted, and how long we remember ids Spotify doesn't know
+SPOTIFY_CACHE_TTL_HOURS = int(os.getenv('SPOTIFY_CACHE_TTL_HOURS', '168'))
+SPOTIFY_NEGATIVE_TTL_MINUTES = int(os.getenv('SPOTIFY_NEGATIVE_TTL_MINUTES', '60'))
+# How long a YouTube search result is reused
+YOUTUBE_MATCH_TTL_DAYS = int(os.getenv('YOUTUBE_MATCH_TTL_DAYS', '30'))
+
+# Bits of track titles that differ between releases of the same recording
+TITLE_NOISE = re.compile(r'\s*[\(\[](feat\.?|ft\.?|with)\s[^\)\]]*[\)\]]|\s+-\s+.*(remaster|version|edit|mono|stereo).*$', re.IGNORECASE)
+
+class TrackCache:
+    """Spotify track metadata in a Mongo collection, keyed by Spotify track id.
+
+    Documents expire through a TTL index on expires_at. Ids Spotify returned
+    nothing for are cached too (info None) so they aren't looked up again and
+    again, but for a much shorter time.
+    """
+
+    def __init__(self, collection, ttl=None, negative_ttl=None):
+        self.collection = collection
+        self.ttl = ttl or timedelta(hours=SPOTIFY_CACHE_TTL_HOURS)
+        self.negative_ttl = negative_ttl or timedelta(minutes=SPOTIFY_NEGATIVE_TTL_MINUTES)
+
+    def get_many(self, track_ids):
+        """Cached entries for the given ids: id -> info, or None for known-missing ids.
+
+        Ids we have nothing (fresh) on are left out.
+        """
+        now = datetime.utcnow()
+        found = {}
+        for doc in self.collection.find({'_id': {'$in': list(track_ids)}, 'expires_at': {'$gt': now}}):
+            found[doc['_id']] = doc['info']
+        metrics.incr('spotify_cache.hits', len(found))
+        metrics.incr('spotify_cache.misses', len(set(track_ids)) - len(found))
+        return found
+
+    def put_many(self, entries):
+        """Store id -> info pairs; info None records the id as missing"""
+        if not entries:
+            return
+        now = datetime.utcnow()
+        self.collection.bulk_write([
+            UpdateOne(
+                {'_id': track_id},
+                {'$set': {
+                    'info': info,
+                    'expires_at': now + (self.ttl if info is not None else self.negative_ttl),
+                    'updated_at': now
+                }},
+                upsert=True
+            )
+            for track_id, info in entries.items()
+        ], ordered=False)
+
+class TrackBatcher:
+    """Merges concurrent lookups into batched calls.
+
+    The first caller opens a batch; it is flushed after max_wait seconds, or
+    as soon as it holds max_batch ids. fetch(ids) returns id -> value, and
+    every caller waiting on one of those ids gets its value.
+    """
+
+    def __init__(self, fetch, max_batch=50, max_wait=0.05):
+        self.fetch = fetch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+
+    def get(self, key, timeout=None):
+        batch = None
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = Future()
+                self._pending[key] = future
+                if len(self._pending) >= self.max_batch:
+                    batch = self._take()
+                elif self._timer is None:
+                    self._timer = threading.Timer(self.max_wait, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            # A full batch is fetched by the caller that filled it
+            self._run(batch)
+        return future.result(timeout)
+
+    def _take(self):
+        batch = self._pending
+        self._pending = {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch):
+        metrics.incr('spotify_cache.batches')
+        try:
+            results = self.fetch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for key, future in batch.items():
+            future.set_result(results.get(key))
+
+def normalize_track(title, artist, duration=None):
+    """Match key for a recording: lowercased title and artist without featuring/remaster noise,
+    and the duration in 5 second steps"""
+    title = TITLE_NOISE.sub('', title or '')
+    parts = [re.sub(r'[^\w]+', ' ', re.sub(r"['’]", '', part.lower())).strip() for part in (title, artist or '')]
+    if duration:
+        parts.append(str(int(duration) // 5))
+    return '|'.join(parts)
+
+class MatchCache:
+    """The YouTube video chosen for a track, so the search runs once per track.
+
+    Entries are stored under the Spotify track id and under the normalized
+    title/artist/duration, so the same recording found through another
+    Spotify id (a single vs. the album cut) reuses the match. Manual
+    overrides never expire and win over searched matches.
+    """
+
+    def __init__(self, collection, ttl=None):
+        self.collection = collection
+        self.ttl = ttl or timedelta(days=YOUTUBE_MATCH_TTL_DAYS)
+
+    def keys(self, spotify_id=None, title=None, artist=None, duration=None):
+        keys = []
+        if spotify_id:
+            keys.append(f"spotify:{spotify_id}")
+        if title:
+            keys.append(f"track:{normalize_track(title, artist, duration)}")
+        return keys
+
+    def get(self, keys):
+        """The cached match for the first of keys that has one, manual ones first; None if none"""
+        if not keys:
+            return None
+        now = datetime.utcnow()
+        docs = {doc['_id']: doc for doc in self.collection.find({
+            '_id': {'$in': keys},
+            '$or': [{'source': 'manual'}, {'expires_at': {'$gt': now}}]
+        })}
+        ranked = sorted(docs.values(), key=lambda doc: (doc['source'] != 'manual', keys.index(doc['_id'])))
+        if not ranked:
+            metrics.incr('youtube_matches.misses')
+            return None
+        metrics.incr('youtube_matches.hits')
+        return ranked[0]
+
+    def put(self, keys, video_id, url, source='search'):
+        """Remember the video for every key; manual entries have no expiry"""
+        now = datetime.utcnow()
+        update = {'$set': {'video_id': video_id, 'url': url, 'source': source, 'updated_at': now}}
+        if source == 'manual':
+            update['$unset'] = {'expires_at': ''}
+        else:
+            update['$set']['expires_at'] = now + self.ttl
+        for key in keys:
+            query = {'_id': key}
+            if source != 'manual':
+                # Never overwrite an override with a search result
+                query['source'] = {'$ne': 'manual'}
+            try:
+                self.collection.update_one(query, update, upsert=True)
+            except DuplicateKeyError:
+                # Key is held by a manual override
+                pass
+
+    def delete(self, keys):
+        return self.collection.delete_many({'_id': {'$in': keys}}).deleted_count
+
+track_cache = TrackCache(db.spotify_tracks)
+match_cache = MatchCache(db.youtube_matches)
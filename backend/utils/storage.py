@@ -0,0 +1,63 @@
+from flask import current_app
+import hashlib
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Blob names start with their SHA-256, so they can be sharded on it directly
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}\.')
+
+def get_uploads_dir():
+    """Directory holding the audio files, created on first use"""
+    uploads_dir = os.path.join(current_app.root_path, 'uploads')
+    os.makedirs(uploads_dir, exist_ok=True)
+    return uploads_dir
+
+def shard_dir(name):
+    """Two-level fan-out directory for a stored file name, e.g. 'ab/cd'"""
+    key = name if BLOB_NAME.match(name) else hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return os.path.join(key[:2], key[2:4])
+
+def sharded_path(root, name):
+    """Where a file lives in the sharded layout"""
+    return os.path.join(root, shard_dir(name), name)
+
+def legacy_path(root, name):
+    """Where a file lived in the old flat layout"""
+    return os.path.join(root, name)
+
+def resolve_path(root, name):
+    """Find a stored file, preferring the sharded layout.
+
+    Falls back to the flat layout so files not migrated yet keep working, and
+    looks in the sharded location once more in case the migration moved the
+    file between the two checks. Returns the sharded path if it exists nowhere.
+    """
+    path = sharded_path(root, name)
+    if os.path.exists(path):
+        return path
+    flat = legacy_path(root, name)
+    if os.path.exists(flat):
+        return flat
+    return path
+
+def locate(name):
+    """Absolute path of a song's file_path in the uploads dir"""
+    return resolve_path(get_uploads_dir(), name)
+
+def migrate_file(root, name):
+    """Move one file from the flat layout into its shard; returns the new path or None"""
+    source = legacy_path(root, name)
+    target = sharded_path(root, name)
+    if not os.path.isfile(source):
+        return None
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):
+        # Same name means same content for blobs; keep the copy already in place
+        os.remove(source)
+    else:
+        # Atomic on the same filesystem, readers see one path or the other
+        os.replace(source, target)
+    return target
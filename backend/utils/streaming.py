@@ -0,0 +1,74 @@
+from flask import request, send_file, Response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from urllib.parse import quote
+import mimetypes
+import os
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+AUDIO_MIMETYPES = {
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+    '.ogg': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.webm': 'audio/webm',
+}
+
+def audio_mimetype(path):
+    """Guess the mimetype of an audio file from its extension"""
+    ext = os.path.splitext(path)[1].lower()
+    return AUDIO_MIMETYPES.get(ext) or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+def wants_inline():
+    """Check whether the client asked for inline playback instead of a download"""
+    if request.args.get('disposition', '').lower() == 'inline':
+        return True
+    return request.args.get('inline', '').lower() in ('1', 'true', 'yes')
+
+def content_disposition(download_name, inline=False):
+    """Build a Content-Disposition header the same way send_file does"""
+    value = 'inline' if inline else 'attachment'
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        return f'{value}; filename="{simple}"; filename*=UTF-8\'\'{quoted}'
+    escaped = download_name.replace('\\', '\\\\').replace('"', '\\"')
+    return f'{value}; filename="{escaped}"'
+
+def send_audio(path, download_name, mimetype=None, inline=False):
+    """Send an audio file with HTTP Range / 206 Partial Content support"""
+    mimetype = mimetype or audio_mimetype(path)
+
+    try:
+        # conditional=True lets werkzeug answer Range and If-Range against the
+        # file's ETag / Last-Modified and reply with 206, 304 or 416. It only
+        # serves single ranges (multipart/byteranges isn't worth it for audio
+        # players, which never ask for them) and answers 416 to several, but
+        # only once If-Range has matched; otherwise the whole file goes out
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=not inline,
+            download_name=download_name,
+            conditional=True,
+            etag=True
+        )
+    except RequestedRangeNotSatisfiable as e:
+        logger.debug(f"Unsatisfiable range {request.headers.get('Range')} for {os.path.getsize(path)} bytes")
+        return e.get_response()
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+def stream_audio(body, download_name, mimetype, inline=False):
+    """Send a body of unknown length as a chunked response (no Range support)"""
+    response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Disposition'] = content_disposition(download_name, inline)
+    response.headers['Accept-Ranges'] = 'none'
+    # Stop reverse proxies from buffering the whole body before sending it on
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
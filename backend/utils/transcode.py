@@ -0,0 +1,261 @@
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import logging
+from utils.scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+
+# Renditions we can produce on request, keyed by the ?format= value
+RENDITIONS = {
+    'wav': {
+        'ext': 'wav',
+        'format': 'wav',
+        'mimetype': 'audio/wav',
+        'codec': 'pcm_s16le',
+        'sample_rate': 44100,
+        'args': ['-acodec', 'pcm_s16le', '-ar', '44100']
+    },
+    # Native (Opus/Vorbis) imports are only turned into MP3 when a client asks
+    'mp3': {
+        'ext': 'mp3',
+        'format': 'mp3',
+        'mimetype': 'audio/mpeg',
+        'codec': 'libmp3lame',
+        'sample_rate': 44100,
+        'args': ['-vn', '-acodec', 'libmp3lame', '-b:a', '192k', '-ar', '44100']
+    }
+}
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# At most one ffmpeg per core; everyone else queues (fairly, per user) or gets a 503
+TRANSCODE_SLOTS = int(os.getenv('TRANSCODE_SLOTS') or os.cpu_count() or 2)
+transcode_scheduler = FairScheduler(
+    'transcode',
+    slots=TRANSCODE_SLOTS,
+    max_queue=int(os.getenv('TRANSCODE_QUEUE_SIZE') or TRANSCODE_SLOTS * 4),
+    queue_timeout=float(os.getenv('TRANSCODE_QUEUE_TIMEOUT', '30'))
+)
+
+class TranscodeError(Exception):
+    pass
+
+def ffmpeg_command(source_path, rendition, output):
+    """Build the ffmpeg command line for a rendition"""
+    return [
+        'ffmpeg', '-y',  # -y to overwrite output file
+        '-loglevel', 'error',
+        '-i', source_path,
+        *rendition['args'],
+        '-f', rendition['format'],  # Explicit, the output name may not carry an extension
+        output
+    ]
+
+def transcode_file(source_path, rendition, output_path):
+    """Convert source_path into the given rendition at output_path"""
+    command = ffmpeg_command(source_path, rendition, output_path)
+    logger.debug(f"Running ffmpeg command: {' '.join(command)}")
+    process = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    if process.returncode != 0:
+        error_output = process.stderr.decode(errors='replace')
+        logger.error(f"FFmpeg conversion failed: {error_output}")
+        raise TranscodeError(error_output)
+
+def fix_wav_header(path):
+    """Fill in the RIFF and data chunk sizes ffmpeg leaves blank when writing to a pipe"""
+    size = os.path.getsize(path)
+    if size > 0xFFFFFFFF:
+        return
+
+    with open(path, 'r+b') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return
+
+        # Walk the chunks until we find 'data'
+        offset = 12
+        while offset + 8 <= size:
+            f.seek(offset)
+            chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+            if chunk_id == b'data':
+                f.seek(4)
+                f.write(struct.pack('<I', size - 8))
+                f.seek(offset + 4)
+                f.write(struct.pack('<I', size - offset - 8))
+                return
+            offset += 8 + chunk_size + (chunk_size & 1)
+
+class StreamingFill:
+    """A rendition cache fill that clients can stream while ffmpeg is still writing it.
+
+    ffmpeg's stdout is copied into the fill by a background thread, so the
+    transcode runs at ffmpeg's pace rather than the first client's, and the
+    fill is published as soon as ffmpeg exits cleanly. Clients read the growing
+    file through follow(); others asking for the same rendition meanwhile join
+    it. If every client goes away before it's done, ffmpeg is killed and the
+    partial file discarded. on_done runs once ffmpeg has finished either way.
+    """
+
+    def __init__(self, key, source_path, rendition, pending, chunk_size=STREAM_CHUNK_SIZE, on_done=None):
+        self.key = key
+        self.rendition = rendition
+        self.pending = pending
+        self.chunk_size = chunk_size
+        self.on_done = on_done
+        self.process = None
+        self.output = None
+        self.stderr = None
+        self.readers = 0
+        self.finished = False
+        self.error = None
+        self._cond = threading.Condition()
+
+        command = ffmpeg_command(source_path, rendition, 'pipe:1')
+        logger.debug(f"Streaming ffmpeg command: {' '.join(command)}")
+        try:
+            self.stderr = tempfile.TemporaryFile()
+            self.output = open(pending.path, 'wb')
+            self.process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=self.stderr
+            )
+            with _fills_lock:
+                _fills[key] = self
+            threading.Thread(target=self._pump, name=f"transcode-{key[:12]}", daemon=True).start()
+        except BaseException as e:
+            self._finish(completed=False, error=str(e))
+            raise
+
+    def _pump(self):
+        completed = False
+        error = None
+        try:
+            while True:
+                chunk = self.process.stdout.read1(self.chunk_size)
+                if not chunk:
+                    break
+                self.output.write(chunk)
+                self.output.flush()
+                with self._cond:
+                    self._cond.notify_all()
+
+            if self.process.wait() == 0:
+                completed = True
+            elif self.readers:
+                self.stderr.seek(0)
+                error = self.stderr.read().decode(errors='replace')
+                logger.error(f"FFmpeg streaming conversion failed: {error}")
+            else:
+                error = 'Abandoned by every client'
+        except Exception as e:
+            logger.error(f"Error streaming conversion of {self.key}: {str(e)}")
+            error = str(e)
+        finally:
+            self._finish(completed, error)
+
+    def _finish(self, completed, error=None):
+        if self.process:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+        if self.stderr:
+            self.stderr.close()
+        if self.output:
+            self.output.close()
+
+        with self._cond:
+            try:
+                if completed:
+                    if self.rendition['format'] == 'wav':
+                        fix_wav_header(self.pending.path)
+                    self.pending.commit()
+                else:
+                    self.pending.abort()
+            except Exception as e:
+                logger.error(f"Error finishing cached rendition: {str(e)}")
+                error = error or str(e)
+            self.error = error
+            self.finished = True
+            self._cond.notify_all()
+
+        with _fills_lock:
+            if _fills.get(self.key) is self:
+                del _fills[self.key]
+        if self.on_done:
+            self.on_done()
+
+    def follow(self):
+        """A reader of the rendition from its first byte, or None if the fill already finished"""
+        with self._cond:
+            if self.finished:
+                return None
+            # Opened before the fill can be published (renamed), so the reader keeps the file
+            reader = FillReader(self, open(self.pending.path, 'rb'))
+            self.readers += 1
+            return reader
+
+    def _leave(self):
+        with self._cond:
+            self.readers -= 1
+            if self.readers == 0 and not self.finished and self.process.poll() is None:
+                logger.debug(f"Every client went away, killing ffmpeg for {self.key}")
+                self.process.kill()
+
+class FillReader:
+    """Iterable over a StreamingFill's file, waiting for ffmpeg when it catches up.
+
+    close() is called by the WSGI server when the client goes away.
+    """
+
+    def __init__(self, fill, file):
+        self.fill = fill
+        self.file = file
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.file.read(self.fill.chunk_size)
+                if chunk:
+                    yield chunk
+                    continue
+                with self.fill._cond:
+                    if not self.fill.finished:
+                        self.fill._cond.wait(1.0)
+                        continue
+                # Finished: whatever was written is in the file now
+                for chunk in iter(lambda: self.file.read(self.fill.chunk_size), b''):
+                    yield chunk
+                if self.fill.error:
+                    raise TranscodeError(self.fill.error)
+                return
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        self.fill._leave()
+
+# Streaming fills in progress, by rendition key
+_fills = {}
+_fills_lock = threading.Lock()
+
+def follow_fill(key):
+    """Join a streaming fill of key in progress; None if there isn't one"""
+    with _fills_lock:
+        fill = _fills.get(key)
+    return fill.follow() if fill else None
@@ -0,0 +1,209 @@
+from database import db
+from bson import ObjectId
+from datetime import datetime, timedelta
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024  # Stay under serverless request body limits
+MAX_RESUMABLE_UPLOAD_BYTES = int(os.getenv('MAX_RESUMABLE_UPLOAD_MB', '500')) * 1024 * 1024
+SESSION_TTL = timedelta(hours=int(os.getenv('UPLOAD_SESSION_TTL_HOURS', '24')))
+GC_INTERVAL_SECONDS = 15 * 60
+
+class UploadSessionError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class ChunkReader:
+    """File-like object reading a session's chunk files back to back"""
+
+    def __init__(self, paths):
+        self._paths = list(paths)
+        self._current = None
+
+    def read(self, size=-1):
+        while True:
+            if self._current is None:
+                if not self._paths:
+                    return b''
+                self._current = open(self._paths.pop(0), 'rb')
+            data = self._current.read(size)
+            if data:
+                return data
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current:
+            self._current.close()
+            self._current = None
+
+class UploadSessions:
+    """Resumable upload sessions: metadata in Mongo, chunks as files on disk.
+
+    Chunks are numbered from 0 and are all chunk_size bytes except the last.
+    They can arrive in any order and in parallel; a session is finished by
+    reading the chunks back in order through the normal ingest path.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._last_gc = 0
+        self._gc_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _session_dir(self, session_id):
+        return os.path.join(self.root, session_id)
+
+    def _chunk_path(self, session_id, index):
+        return os.path.join(self._session_dir(session_id), f"{index:06d}.part")
+
+    def create(self, user_id, filename, size, chunk_size=None, title=None, sha256=None):
+        chunk_size = int(chunk_size or DEFAULT_CHUNK_SIZE)
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadSessionError(f'chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes')
+        size = int(size)
+        if size <= 0:
+            raise UploadSessionError('size must be positive')
+        if size > MAX_RESUMABLE_UPLOAD_BYTES:
+            raise UploadSessionError(f'File is larger than {MAX_RESUMABLE_UPLOAD_BYTES // (1024 * 1024)} MB', 413)
+
+        self.collect_garbage()
+
+        now = datetime.utcnow()
+        session = {
+            '_id': str(ObjectId()),
+            'user_id': str(user_id),
+            'filename': filename,
+            'title': title,
+            'sha256': sha256.lower() if sha256 else None,
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': (size + chunk_size - 1) // chunk_size,
+            'received': [],
+            'created_at': now,
+            'expires_at': now + SESSION_TTL
+        }
+        os.makedirs(self._session_dir(session['_id']), exist_ok=True)
+        db.upload_sessions.insert_one(session)
+        logger.debug(f"Created upload session {session['_id']} for {filename} ({size} bytes, {session['total_chunks']} chunks)")
+        return session
+
+    def get(self, session_id, user_id):
+        session = db.upload_sessions.find_one({'_id': session_id, 'user_id': str(user_id)})
+        if not session or session['expires_at'] < datetime.utcnow():
+            raise UploadSessionError('Upload session not found', 404)
+        return session
+
+    def expected_length(self, session, index):
+        if index == session['total_chunks'] - 1:
+            return session['size'] - index * session['chunk_size']
+        return session['chunk_size']
+
+    def put_chunk(self, session, index, stream, checksum=None):
+        """Store one chunk; re-sending a chunk that's already stored simply replaces it"""
+        if not 0 <= index < session['total_chunks']:
+            raise UploadSessionError(f"Chunk index must be between 0 and {session['total_chunks'] - 1}")
+        expected = self.expected_length(session, index)
+
+        session_dir = self._session_dir(session['_id'])
+        os.makedirs(session_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=session_dir, suffix='.tmp')
+        digest = hashlib.sha256()
+        length = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                    length += len(chunk)
+                    if length > expected:
+                        raise UploadSessionError(f'Chunk {index} must be {expected} bytes')
+                    digest.update(chunk)
+                    out.write(chunk)
+            if length != expected:
+                raise UploadSessionError(f'Chunk {index} must be {expected} bytes, got {length}')
+            if checksum and digest.hexdigest() != checksum.lower():
+                raise UploadSessionError(f'Chunk {index} checksum mismatch')
+            os.replace(temp_path, self._chunk_path(session['_id'], index))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        # Every chunk pushes the expiry out again
+        db.upload_sessions.update_one(
+            {'_id': session['_id']},
+            {
+                '$addToSet': {'received': index},
+                '$set': {'expires_at': datetime.utcnow() + SESSION_TTL}
+            }
+        )
+
+    def status(self, session):
+        received = sorted(session['received'])
+        received_set = set(received)
+        missing = [i for i in range(session['total_chunks']) if i not in received_set]
+        return {
+            'id': session['_id'],
+            'filename': session['filename'],
+            'size': session['size'],
+            'chunk_size': session['chunk_size'],
+            'total_chunks': session['total_chunks'],
+            'received': received,
+            'received_offsets': [i * session['chunk_size'] for i in received],
+            'missing': missing,
+            'complete': not missing,
+            'expires_at': session['expires_at'].isoformat()
+        }
+
+    def open_chunks(self, session):
+        """Reader over all chunks in order; fails if any are missing"""
+        paths = [self._chunk_path(session['_id'], i) for i in range(session['total_chunks'])]
+        missing = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+        if missing:
+            raise UploadSessionError(f'Missing chunks: {missing[:20]}', 409)
+        return ChunkReader(paths)
+
+    def delete(self, session_id):
+        db.upload_sessions.delete_one({'_id': session_id})
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def collect_garbage(self, force=False):
+        """Remove chunk directories of sessions that expired or no longer exist.
+
+        Mongo drops the session documents through a TTL index on expires_at;
+        this cleans up their files. Runs at most every GC_INTERVAL_SECONDS.
+        """
+        with self._gc_lock:
+            if not force and time.time() - self._last_gc < GC_INTERVAL_SECONDS:
+                return
+            self._last_gc = time.time()
+
+        now = datetime.utcnow()
+        removed = 0
+        for session_id in os.listdir(self.root):
+            session_dir = self._session_dir(session_id)
+            try:
+                age = time.time() - os.path.getmtime(session_dir)
+            except FileNotFoundError:
+                continue
+            # Give brand new sessions a moment to get their document inserted
+            if age < 60:
+                continue
+            session = db.upload_sessions.find_one({'_id': session_id}, {'expires_at': 1})
+            if session and session['expires_at'] > now:
+                continue
+            if session:
+                db.upload_sessions.delete_one({'_id': session_id})
+            shutil.rmtree(session_dir, ignore_errors=True)
+            removed += 1
+        if removed:
+            logger.info(f"Garbage-collected {removed} expired upload sessions")
@@ -0,0 +1,160 @@
+"""Background workers for queued jobs (Spotify imports).
+
+Runs a pool of processes that claim jobs from the Mongo-backed queue, so
+imports don't tie up web workers. Scale it independently of the web tier:
+
+    python worker.py --processes 4 --threads 4
+"""
+from dotenv import load_dotenv
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import uuid
+
+load_dotenv()
+
+logger = logging.getLogger('worker')
+
+def run_job(job, job_queue, handlers, downloader, lease_seconds, progress):
+    """Run one claimed job, heartbeating its lease until it finishes"""
+    from utils.resilience import CircuitOpen
+
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(lease_seconds / 3):
+            if not job_queue.heartbeat(job, lease_seconds):
+                logger.warning(f"Lost the lease on job {job['_id']}, another worker may pick it up")
+                return
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    try:
+        result = handlers[job['type']](job, downloader)
+        job_queue.complete(job, result)
+        logger.info(f"Job {job['_id']} succeeded")
+    except CircuitOpen as e:
+        if e.recovering or job_queue.can_defer(job):
+            # Spotify or YouTube is throttling us: wait it out, this doesn't count as an attempt
+            job_queue.defer(job, e.retry_after, str(e), count=not e.recovering)
+            progress.publish(job, 'paused', retry_after=e.retry_after)
+        else:
+            logger.error(f"Job {job['_id']} deferred too often, failing it: {str(e)}")
+            job_queue.fail(job, str(e))
+            progress.publish(job, 'failed', error=str(e), will_retry=job['attempts'] < job.get('max_attempts', 1))
+    except Exception as e:
+        logger.error(f"Job {job['_id']} failed: {str(e)}")
+        job_queue.fail(job, str(e))
+        progress.publish(job, 'failed', error=str(e), will_retry=job['attempts'] < job.get('max_attempts', 1))
+    finally:
+        done.set()
+        beat.join()
+
+def worker_main(poll_interval, lease_seconds, threads):
+    """Entry point of one worker process, running up to threads jobs at once.
+
+    Jobs in one process share its download scheduler, so an interactive
+    import doesn't wait behind a whole playlist claimed earlier.
+    """
+    # Imported here so every spawned process opens its own Mongo connection
+    from app import app
+    from utils.jobs import job_queue
+    from utils.events import progress
+    from utils.metrics import metrics
+    from utils.imports import HANDLERS, get_downloader
+    from utils.resilience import spotify_breaker, youtube_breaker
+
+    process_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    with app.app_context():
+        downloader = get_downloader()
+
+    def loop(worker_id):
+        with app.app_context():
+            while not stop.is_set():
+                # Don't claim work that would only be deferred again
+                paused = max(spotify_breaker.remaining(), youtube_breaker.remaining())
+                if paused:
+                    # Re-check often: a trial call in flight may close the circuit early
+                    stop.wait(min(paused, poll_interval))
+                    continue
+                try:
+                    job = job_queue.claim(worker_id, lease_seconds, job_types=HANDLERS.keys())
+                except Exception as e:
+                    logger.error(f"Error claiming job: {str(e)}")
+                    job = None
+                if not job:
+                    stop.wait(poll_interval)
+                    continue
+                run_job(job, job_queue, HANDLERS, downloader, lease_seconds, progress)
+
+    runners = [threading.Thread(target=loop, args=(f"{process_id}:{i}",)) for i in range(threads)]
+    for runner in runners:
+        runner.start()
+    logger.info(f"Worker {process_id} started with {threads} job threads")
+    # Download scheduler gauges and timings live in this process; log them now and then,
+    # and fail jobs that crashed their worker on every attempt
+    while not stop.wait(60):
+        logger.info(f"Worker {process_id} metrics: {metrics.snapshot()}")
+        try:
+            job_queue.fail_abandoned()
+        except Exception as e:
+            logger.error(f"Error failing abandoned jobs: {str(e)}")
+    for runner in runners:
+        runner.join()
+    logger.info(f"Worker {process_id} stopped")
+
+def main():
+    parser = argparse.ArgumentParser(description='Run background job workers')
+    parser.add_argument('--processes', type=int, default=int(os.getenv('IMPORT_WORKERS', '2')))
+    parser.add_argument('--threads', type=int, default=int(os.getenv('JOB_THREADS', '4')), help='Jobs run at once per process')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--lease-seconds', type=int, default=60)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    # spawn, not fork: pymongo clients must not be shared across a fork
+    context = multiprocessing.get_context('spawn')
+    stopping = threading.Event()
+
+    def start():
+        process = context.Process(target=worker_main, args=(args.poll_interval, args.lease_seconds, args.threads))
+        process.start()
+        return process
+
+    def shutdown(*_):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    processes = [start() for _ in range(args.processes)]
+    logger.info(f"Started {len(processes)} worker processes")
+
+    # Replace workers that die until we're told to stop
+    while not stopping.is_set():
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                logger.warning(f"Worker process {process.pid} exited with {process.exitcode}, restarting")
+                processes[i] = start()
+        stopping.wait(2)
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    logger.info("All workers stopped")
+
+if __name__ == '__main__':
+    main()
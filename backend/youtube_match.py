@@ -0,0 +1,49 @@
+"""Inspect or override the YouTube video used for a Spotify track.
+
+Overrides never expire and take precedence over searched matches.
+
+    python youtube_match.py show <spotify track url or id>
+    python youtube_match.py set <spotify track url or id> <youtube url>
+    python youtube_match.py clear <spotify track url or id>
+"""
+from dotenv import load_dotenv
+import argparse
+import re
+
+load_dotenv()
+
+from utils.spotify import parse_spotify_url
+from utils.spotify_cache import match_cache
+
+YOUTUBE_ID = re.compile(r'(?:v=|youtu\.be/|/shorts/)([\w-]{11})')
+
+def track_id(value):
+    parsed = parse_spotify_url(value)
+    return parsed[1] if parsed else value
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage cached YouTube matches')
+    parser.add_argument('action', choices=['show', 'set', 'clear'])
+    parser.add_argument('track', help='Spotify track URL or id')
+    parser.add_argument('youtube_url', nargs='?')
+    args = parser.parse_args()
+
+    keys = match_cache.keys(spotify_id=track_id(args.track))
+
+    if args.action == 'show':
+        match = match_cache.get(keys)
+        print(f"{match['url']} ({match['source']})" if match else 'No match cached')
+    elif args.action == 'set':
+        if not args.youtube_url:
+            parser.error('set needs a YouTube URL')
+        video = YOUTUBE_ID.search(args.youtube_url)
+        if not video:
+            parser.error(f"Not a YouTube video URL: {args.youtube_url}")
+        url = f"https://www.youtube.com/watch?v={video.group(1)}"
+        match_cache.put(keys, video.group(1), url, source='manual')
+        print(f"{keys[0]} -> {url}")
+    else:
+        print(f"Removed {match_cache.delete(keys)} entries")
+
+if __name__ == '__main__':
+    main()
@@ -70,15 +70,12 @@ const Upload = ({ onUploadSuccess }) => {
 
       let response;
       if (uploadType === 0) {
-        // File upload
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('title', title || file.name);
-
-        response = await axios.post('http://localhost:5000/api/songs/upload', formData, {
+        // File upload, sent as the raw body so the server can stream it to disk
+        response = await axios.post('http://localhost:5000/api/songs/upload', file, {
+          params: { filename: file.name, title: title || file.name },
           headers: {
             'Authorization': `Bearer ${token}`,
-            'Content-Type': 'multipart/form-data'
+            'Content-Type': file.type || 'application/octet-stream'
           }
         });
       } else {
@@ -94,6 +94,12 @@ export const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
+    if (localStorage.getItem('token')) {
+      // Revoke the token server-side; nothing to do here if that fails
+      axios.post('/api/auth/logout').catch((error) => {
+        console.error('Logout error:', error);
+      });
+    }
     setAuthToken(null);
     setIsAuthenticated(false);
     setUser(null);
@@ -107,32 +107,25 @@ const Home = () => {
         audioElement.src = '';
       }
 
-      // Create blob URL with authenticated request
-      const response = await axios({
-        method: 'GET',
-        url: `http://localhost:5000/api/songs/stream/${song._id}`,
+      // Get a signed URL so the browser can stream the song itself (with Range requests)
+      const response = await axios.post(`/api/songs/stream/${song._id}/url`, null, {
         headers: {
           'Authorization': `Bearer ${token}`
-        },
-        responseType: 'blob'
+        }
       });
-
-      const blob = new Blob([response.data], { type: 'audio/mpeg' });
-      const audioUrl = URL.createObjectURL(blob);
+      const audioUrl = `${axios.defaults.baseURL || ''}${response.data.url}&inline=1`;
 
       // Create new audio element
       const audio = new Audio(audioUrl);
-      
+
       // Add event listeners
       audio.addEventListener('ended', () => {
         setIsPlaying(false);
-        URL.revokeObjectURL(audioUrl);
       });
 
       audio.addEventListener('error', (e) => {
         console.error('Audio playback error:', e);
         setError('Error playing audio');
-        URL.revokeObjectURL(audioUrl);
       });
 
       // Play the audio
@@ -1,4 +1,4 @@
-import React, { useState, useRef } from 'react';
+import React, { useState, useRef, useEffect } from 'react';
 import {
   Box,
   Button,
@@ -15,6 +15,81 @@ import { CloudUpload, Link as LinkIcon } from '@mui/icons-material';
 import axios from 'axios';
 import { useNavigate } from 'react-router-dom';
 
+const SPOTIFY_URL = /^https:\/\/open\.spotify\.com\/(intl-[a-z-]+\/)?(track|album|playlist)\//;
+
+const STAGE_LABELS = {
+  metadata: 'Fetching track info',
+  search: 'Finding the track',
+  download: 'Downloading',
+  postprocess: 'Processing audio',
+  paused: 'Waiting for Spotify/YouTube, will resume shortly',
+  saved: 'Saved',
+  failed: 'Failed'
+};
+
+// Reads the job event stream (Server-Sent Events) with fetch, since
+// EventSource can't send the Authorization header. Resumes after
+// lastEventId.current if set, and keeps it up to date. Returns true once
+// onEvent returns false, false if the stream ended before that.
+const readJobEvents = async (jobId, lastEventId, onEvent, signal) => {
+  const headers = { Authorization: axios.defaults.headers.common['Authorization'] };
+  if (lastEventId.current) {
+    headers['Last-Event-ID'] = lastEventId.current;
+  }
+  // The server replays what the job already published before following it
+  const response = await fetch(`${axios.defaults.baseURL || ''}/api/jobs/events?job=${jobId}`, {
+    headers,
+    signal
+  });
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) return false;
+    buffer += decoder.decode(value, { stream: true });
+    const messages = buffer.split('\n\n');
+    buffer = messages.pop();
+    for (const message of messages) {
+      const lines = message.split('\n');
+      const idLine = lines.find((line) => line.startsWith('id: '));
+      if (idLine) {
+        lastEventId.current = idLine.slice(4);
+      }
+      const dataLine = lines.find((line) => line.startsWith('data: '));
+      if (!dataLine) continue;
+      const event = JSON.parse(dataLine.slice(6));
+      if (event.job_id === jobId && onEvent(event) === false) return true;
+    }
+  }
+};
+
+// Follows a job's events until onEvent is done with them. If the stream
+// drops first (proxy timeout, server restart), checks the job itself in
+// case it already finished and its final event was missed, then
+// reconnects where it left off.
+const followJobEvents = async (jobId, onEvent, signal) => {
+  const lastEventId = { current: null };
+  for (;;) {
+    try {
+      if (await readJobEvents(jobId, lastEventId, onEvent, signal)) return;
+    } catch (error) {
+      if (signal.aborted) throw error;
+      console.error('Job event stream error:', error);
+    }
+    const { data } = await axios.get(`/api/jobs/${jobId}`, { signal });
+    if (data.job.status === 'succeeded') {
+      onEvent({ job_id: jobId, stage: 'saved' });
+      return;
+    }
+    if (data.job.status === 'failed') {
+      onEvent({ job_id: jobId, stage: 'failed', error: data.job.error });
+      return;
+    }
+    await new Promise((resolve) => setTimeout(resolve, 3000));
+  }
+};
+
 const Upload = () => {
   const [uploadType, setUploadType] = useState(0); // 0 for file, 1 for Spotify
   const [file, setFile] = useState(null);
@@ -25,9 +100,14 @@ const Upload = () => {
   const [uploading, setUploading] = useState(false);
   const [error, setError] = useState('');
   const [progress, setProgress] = useState(0);
+  const [importStatus, setImportStatus] = useState('');
   const fileInputRef = useRef(null);
+  const eventsRef = useRef(null);
   const navigate = useNavigate();
 
+  // Stop listening for import progress when leaving the page
+  useEffect(() => () => eventsRef.current?.abort(), []);
+
   const handleTabChange = (event, newValue) => {
     setUploadType(newValue);
     setError('');
@@ -65,16 +145,13 @@ const Upload = () => {
     setUploading(true);
     setError('');
 
-    const formData = new FormData();
-    formData.append('file', file);
-    formData.append('title', title);
-    formData.append('artist', artist);
-    formData.append('album', album);
-
     try {
-      await axios.post('/api/songs/upload', formData, {
+      // Send the file itself as the body so the server streams it to disk
+      // as it arrives, instead of spooling a multipart form first
+      await axios.post('/api/songs/upload', file, {
+        params: { filename: file.name, title, artist, album },
         headers: {
-          'Content-Type': 'multipart/form-data',
+          'Content-Type': file.type || 'application/octet-stream',
         },
         onUploadProgress: (progressEvent) => {
           const percentCompleted = Math.round((progressEvent.loaded * 100) / progressEvent.total);
@@ -99,8 +176,8 @@ const Upload = () => {
     }
 
     // Validate Spotify URL format
-    if (!spotifyUrl.startsWith('https://open.spotify.com/track/')) {
-      setError('Invalid Spotify URL format. Must be a Spotify track URL.');
+    if (!SPOTIFY_URL.test(spotifyUrl)) {
+      setError('Invalid Spotify URL format. Must be a Spotify track, album or playlist URL.');
       return;
     }
 
@@ -111,7 +188,30 @@ const Upload = () => {
       console.log('Sending Spotify upload request:', { url: spotifyUrl });
       const response = await axios.post('/api/songs/upload/spotify', { url: spotifyUrl });
       console.log('Spotify upload response:', response.data);
-      navigate('/');
+
+      // The import runs in the background; follow its progress until it's done
+      const jobId = response.data.job.id;
+      setImportStatus('Queued');
+      eventsRef.current = new AbortController();
+      let succeeded = false;
+      await followJobEvents(jobId, (event) => {
+        setImportStatus(STAGE_LABELS[event.stage] || event.stage);
+        if (event.stage === 'download' && event.total_bytes) {
+          setProgress(Math.round((event.downloaded_bytes * 100) / event.total_bytes));
+        }
+        if (!event.track && event.stage === 'saved') {
+          succeeded = true;
+          return false;
+        }
+        if (!event.track && event.stage === 'failed' && !event.will_retry) {
+          setError(event.error || 'Failed to import from Spotify');
+          return false;
+        }
+        return true;
+      }, eventsRef.current.signal);
+      if (succeeded) {
+        navigate('/');
+      }
     } catch (err) {
       console.error('Spotify upload error:', err);
       if (err.response) {
@@ -126,6 +226,8 @@ const Upload = () => {
       }
     } finally {
       setUploading(false);
+      setProgress(0);
+      setImportStatus('');
     }
   };
 
@@ -216,7 +318,7 @@ const Upload = () => {
             <TextField
               fullWidth
               label="Spotify URL"
-              placeholder="https://open.spotify.com/track/..."
+              placeholder="https://open.spotify.com/track/... (or an album or playlist)"
               value={spotifyUrl}
               onChange={(e) => setSpotifyUrl(e.target.value)}
               required
@@ -229,7 +331,11 @@ const Upload = () => {
               disabled={uploading || !spotifyUrl}
             >
               {uploading ? (
-                <CircularProgress size={24} sx={{ mr: 1 }} />
+                <>
+                  <CircularProgress size={24} sx={{ mr: 1 }} />
+                  {importStatus}
+                  {progress > 0 && ` ${progress}%`}
+                </>
               ) : (
                 'Download from Spotify'
               )}